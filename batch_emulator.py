@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Batch SSEM emulator. This holds the state of many machines in NumPy
+# arrays and advances all of them at once, for working out expected
+# results for large numbers of test vectors. It gives exactly the same
+# results as SSEM_State.advance in emulator.py, including the
+# unsupported_flag, but doesn't log each instruction.
+
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from constants import *
+from emulator import SSEM_State
+
+def decode_shift():
+    """ The position of the opcode in an instruction word; see SSEM_State.advance. """
+    if memory_columns == 32:
+        return 13
+    elif memory_columns == 8:
+        return 5
+    raise Exception("Memory widths other than 8 or 32 are not supported.")
+
+class SSEM_Batch():
+    """ The state of 'n' SSEMs. pc, accumulator and unsupported_flag are
+    arrays of length n and mem is an n by memory_rows array. Values are
+    held as 64-bit integers, which is plenty for 8 or 32 bit machines. """
+    def __init__(self, n):
+        self.pc = np.zeros(n, dtype=np.int64)
+        self.mem = np.zeros((n, memory_rows), dtype=np.int64)
+        self.accumulator = np.zeros(n, dtype=np.int64)
+        self.unsupported_flag = np.zeros(n, dtype=bool)
+
+    def __len__(self):
+        return len(self.pc)
+
+    @classmethod
+    def from_states(cls, states):
+        """ Makes a batch from a list of SSEM_State. """
+        batch = cls(len(states))
+        batch.pc[:] = [s.pc for s in states]
+        batch.mem[:] = [s.mem for s in states]
+        batch.accumulator[:] = [s.accumulator for s in states]
+        batch.unsupported_flag[:] = [s.unsupported_flag for s in states]
+        return batch
+
+    def state(self, i):
+        """ Returns machine i as an SSEM_State. """
+        s = SSEM_State()
+        s.pc = int(self.pc[i])
+        s.mem = self.mem[i].tolist()
+        s.accumulator = int(self.accumulator[i])
+        s.unsupported_flag = bool(self.unsupported_flag[i])
+        return s
+
+    def states(self):
+        return [self.state(i) for i in range(0, len(self))]
+
+    def copy(self):
+        batch = SSEM_Batch(0)
+        batch.pc = self.pc.copy()
+        batch.mem = self.mem.copy()
+        batch.accumulator = self.accumulator.copy()
+        batch.unsupported_flag = self.unsupported_flag.copy()
+        return batch
+
+    def set_random(self, rng):
+        """ Randomises every machine in the same way as SSEM_State.set_random,
+        using the NumPy Generator 'rng'. """
+        n = len(self)
+        self.pc[:] = rng.integers(0, memory_rows, n)
+        self.mem[:] = rng.integers(0, 256, (n, memory_rows))
+        self.accumulator[:] = rng.integers(0, 1<<memory_columns, n)
+
+    def advance(self):
+        """ Executes one instruction on every machine. """
+        rows = np.arange(len(self))
+        shift = decode_shift()
+        instruction = self.mem[rows, self.pc]
+        address = (instruction & ((1 << shift)-1)) % memory_rows
+        op = (instruction >> shift) & 7
+        operand = self.mem[rows, address]
+
+        self.unsupported_flag |= (op == SB2) | (op == HLT) | ((op == CMP) & (operand != 0))
+
+        pc = self.pc
+        pc = np.where(op == JMP, operand, pc)
+        pc = np.where(op == JRP, (pc + operand) % memory_rows, pc)
+        pc = np.where((op == CMP) & ((self.accumulator & 0x80) == 0x80), pc + 1, pc)
+        pc = np.where(op == HLT, pc - 1, pc)
+        self.pc = (pc + 1) % memory_rows
+
+        subtract = (op == SUB) | (op == SB2)
+        accumulator = np.where(op == LDN, -operand, self.accumulator)
+        accumulator = np.where(subtract, self.accumulator - operand, accumulator)
+        # twos_comp, for the machines which changed their accumulator
+        changed = (op == LDN) | subtract
+        self.accumulator = np.where(changed & (accumulator < 0), accumulator + (1<<memory_columns), accumulator)
+
+        store = np.flatnonzero(op == STO)
+        self.mem[store, address[store]] = self.accumulator[store] & ((2<<memory_columns)-1)
+
+def benchmark(n, cycles, seed=1):
+    """ Runs 'cycles' instructions on 'n' random states with both emulators,
+    checks they agree and returns (scalar seconds, batch seconds). """
+    rng = np.random.default_rng(seed)
+    batch = SSEM_Batch(n)
+    batch.set_random(rng)
+    states = batch.states()
+
+    # Logging (including the unsupported opcode warnings) would dominate the scalar time
+    logging.disable(logging.WARNING)
+    start = time.time()
+    for s in states:
+        for c in range(0, cycles):
+            s.advance()
+    scalar_time = time.time() - start
+    logging.disable(logging.NOTSET)
+
+    start = time.time()
+    for c in range(0, cycles):
+        batch.advance()
+    batch_time = time.time() - start
+
+    for (i, s) in enumerate(states):
+        b = batch.state(i)
+        if (b.pc, b.mem, b.accumulator, b.unsupported_flag) != (s.pc, s.mem, s.accumulator, s.unsupported_flag):
+            raise Exception("Batch emulator disagrees with SSEM_State on machine {}: {} != {}".format(i, b, s))
+    return (scalar_time, batch_time)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the batch emulator with SSEM_State.")
+    parser.add_argument('--states', type=int, default=100000, help="Number of random states")
+    parser.add_argument('--cycles', type=int, default=3, help="Instructions to run on each")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    (scalar_time, batch_time) = benchmark(args.states, args.cycles, args.seed)
+    instructions = args.states * args.cycles
+    print("{} states, {} cycles: results agree".format(args.states, args.cycles))
+    print("SSEM_State:  {:.3f}s ({:.0f} instructions/s)".format(scalar_time, instructions / scalar_time))
+    print("SSEM_Batch:  {:.3f}s ({:.0f} instructions/s)".format(batch_time, instructions / batch_time))
+    print("Speedup: {:.1f}x".format(scalar_time / batch_time))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,132 @@
+# Bearing conservation ledger for the Box2D SSEM.
+
+# Bearings which escape a channel, collect somewhere they shouldn't or get
+# stranded in the second plane eventually corrupt a result, but nothing
+# noticed until the final readout. BearingLedger counts the bearings in
+# each named region of the machine (memory rows, hoppers, subtractor
+# columns and so on; see Memory.regions), per plane, at chosen points in
+# each cycle, and checks the counts which ought to be conserved:
+#
+# * Every bearing is still inside the machine.
+# * At the end of each cycle, nothing is left in plane 1, each memory row
+#   holds one bearing per bit set in the emulator's memory, and the main
+#   injector hopper still has enough bearings to write a whole row.
+#
+# Bearings moving between regions are counted as "in transit".
+
+import numpy as np
+from Box2D import b2_staticBody
+
+from constants import *
+
+# Points in each cycle (out of 10000 ticks, at time_scale 1) at which the ledger is taken by default
+default_points = (500, 4400, 9900)
+# The point at which the end of cycle checks are made. Written bearings
+# land at about tick 9650 and the last bump ends at 9800, so writeback has
+# finished by then; this is the same point as main.memory_check_point.
+cycle_end_point = 9900
+# How far outside the static parts of the machine a bearing can go before it has escaped
+escape_margin = 50
+
+class BearingLedger():
+    """ Counts bearings per region of a Memory (the Box2D SSEM) at the
+    points in machine.ledger_points. Call check() every tick while the cams
+    are turning; entries and violations build up in 'entries' and
+    'violations'. """
+    def __init__(self, machine):
+        self.machine = machine
+        # Resting regions take priority where they overlap the paths into them
+        self.regions = [r for r in machine.regions if r.resting] + [r for r in machine.regions if not r.resting]
+        self.extent = self.machine_extent()
+        self.cycle_end_point = machine.scaled_ticks(cycle_end_point)
+        self.entries = []
+        self.violations = []
+
+    def machine_extent(self):
+        """ (left, bottom, right, top) of everything static in the machine,
+        in machine units, widened by escape_margin. """
+        m = self.machine
+        boxes = []
+        for b in m.world.bodies:
+            if b.type != b2_staticBody:
+                continue
+            for f in b.fixtures:
+                if f.sensor:
+                    continue
+                for child in range(0, f.shape.childCount):
+                    aabb = f.GetAABB(child)
+                    boxes.append((aabb.lowerBound.x, aabb.lowerBound.y, aabb.upperBound.x, aabb.upperBound.y))
+        boxes = np.array(boxes) / m.scale
+        return (boxes[:,0].min() - escape_margin, boxes[:,1].min() - escape_margin,
+                boxes[:,2].max() + escape_margin, boxes[:,3].max() + escape_margin)
+
+    def region_names(self, state):
+        """ The name of the region each bearing is in, or None for parked bearings. """
+        m = self.machine
+        x = state.bearing_position[:,0]
+        y = state.bearing_position[:,1]
+        (row, col, in_memory) = state.memory_cells()
+        names = np.full(len(x), "in transit", dtype=object)
+        placed = np.zeros(len(x), dtype=bool)
+        for r in self.regions:
+            inside = ~placed & (x >= r.left) & (x <= r.right) & (y >= r.bottom) & (y <= r.top)
+            names[inside] = r.name
+            placed |= inside
+        names[in_memory] = ["memory row {}".format(r) for r in row[in_memory]]
+        (left, bottom, right, top) = self.extent
+        # The fake lift returns anything which falls below lift_y, so only the other sides count
+        escaped = ~np.isfinite(x) | ~np.isfinite(y) | (x < left) | (x > right) | (y > top)
+        names[escaped] = "escaped"
+        names[m.spare_bearings] = None
+        return names
+
+    def take(self, sequence):
+        """ Records the bearing count for every region and plane. Returns the
+        entry, as a dictionary of sequence and counts keyed by 'region/plane'. """
+        state = self.machine.capture_state()
+        names = self.region_names(state)
+        counts = {}
+        for (name, plane) in zip(names, state.bearing_plane):
+            if name is not None:
+                key = "{}/{}".format(name, plane)
+                counts[key] = counts.get(key, 0) + 1
+        return { "sequence": sequence, "counts": dict(sorted(counts.items())) }
+
+    def check(self, sequence):
+        """ Takes the ledger if 'sequence' is one of the chosen points and
+        checks it. Returns a list of new violations, which is empty if
+        everything is accounted for. """
+        local_sequence = sequence % self.machine.cycle_ticks
+        recorded = any(local_sequence == self.machine.scaled_ticks(p) for p in self.machine.ledger_points)
+        if not recorded and local_sequence != self.cycle_end_point:
+            return []
+        entry = self.take(sequence)
+        if recorded:
+            self.entries.append(entry)
+        counts = entry["counts"]
+        found = []
+        escaped = sum(n for (key, n) in counts.items() if key.startswith("escaped/"))
+        if escaped:
+            found.append("{} bearings have left the machine".format(escaped))
+        if local_sequence == self.cycle_end_point:
+            found += self.check_cycle_end(sequence, counts)
+        for v in found:
+            self.violations.append("tick {}: {}".format(sequence, v))
+        return found
+
+    def check_cycle_end(self, sequence, counts):
+        m = self.machine
+        found = []
+        stranded = sum(n for (key, n) in counts.items() if key.endswith("/1"))
+        if stranded:
+            found.append("{} bearings left in plane 1".format(stranded))
+        expected = m.expected_cycles[sequence // m.cycle_ticks + 1]
+        for row in range(0, memory_rows):
+            held = counts.get("memory row {}/0".format(row), 0)
+            bits = bin(expected.mem[row] & ((1 << memory_columns)-1)).count("1")
+            if held != bits:
+                found.append("memory row {} holds {} bearings but should hold {}".format(row, held, bits))
+        hopper = counts.get("main injector hopper/0", 0)
+        if hopper < memory_columns:
+            found.append("main injector hopper is down to {} bearings".format(hopper))
+        return found
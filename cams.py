@@ -2,20 +2,22 @@
 
 from collections import namedtuple
 
-_Cam = namedtuple("_Cam", field_names = ["xpos", "ypos", "steps", "offset", "signal_name", "horizontal", "reverse_direction", "bump_height", "follower"])
+_Cam = namedtuple("_Cam", field_names = ["xpos", "ypos", "steps", "offset", "signal_name", "horizontal", "reverse_direction", "bump_height", "follower", "holdoff"])
 
 class Cam(_Cam):
-    def __new__(_cls, xpos, ypos, steps, offset, signal_name, horizontal=False, reverse_direction=False, bump_height=3, follower=True):
+    """ holdoff: The cam only lifts decoder followers clear while their
+    inputs change, and never moves any data itself. """
+    def __new__(_cls, xpos, ypos, steps, offset, signal_name, horizontal=False, reverse_direction=False, bump_height=3, follower=True, holdoff=False):
         'Create new instance of Point(x, y)'
-        return _Cam.__new__(_cls, xpos, ypos, steps, offset, signal_name, horizontal, reverse_direction, bump_height, follower)
+        return _Cam.__new__(_cls, xpos, ypos, steps, offset, signal_name, horizontal, reverse_direction, bump_height, follower, holdoff)
 
 instruction_ready_point = 0.50 # Instruction decoder should be set up, ready for cams to use
 
 cams = [
     Cam(300, 200, [(0.0,0.02)], 1, "PC INJECTOR"),
-    Cam(150,300, [(0.05,0.07), (0.32, 0.06)], 0, "MEMORY DECODER INPUT HOLDOFF"),
+    Cam(150,300, [(0.05,0.07), (0.32, 0.06)], 0, "MEMORY DECODER INPUT HOLDOFF", holdoff=True),
     Cam(-400, 120, [(0.02, 0.07), (0.31,0.1), (0.64,0.1), (0.95,0.03)], -1, "MEMORY RETURN", horizontal=True),
-    Cam(-300,100, [(0.03,0.11), (0.17,0.05), (0.31,0.1), (0.48,0.05), (0.65,0.1), (0.96,0.03)], -1, "MEMORY DECODER OUTPUT HOLDOFF", horizontal=True),
+    Cam(-300,100, [(0.03,0.11), (0.17,0.05), (0.31,0.1), (0.48,0.05), (0.65,0.1), (0.96,0.03)], -1, "MEMORY DECODER OUTPUT HOLDOFF", horizontal=True, holdoff=True),
 
     # Cam 8: Sender eject.
     # Note timing hazard. We cannot raise selector and eject until
@@ -30,13 +32,13 @@ cams = [
     Cam(400,-120, [(0.18, 0.12)], 2, "TO INSTRUCTION REGISTER", horizontal=True, reverse_direction=True, bump_height=4),
 
     # Cam 7: Instruction selector holdoff (vertical)
-    Cam(320, 300, [(0.04, 0.2), (0.32,0.06)], 0, "INSTRUCTION OUTPUT HOLDOFF"),
+    Cam(320, 300, [(0.04, 0.2), (0.32,0.06)], 0, "INSTRUCTION OUTPUT HOLDOFF", holdoff=True),
 
     # Cam 9(?): LDN Trigger.
     Cam(850, 0, [(instruction_ready_point,0.05)], 0, "LDN TRIGGER", horizontal=True, reverse_direction=False, bump_height=4),
 
     # Cam 11(?): Instruction follower holdoff (horizontal)
-    Cam(1000, 100, [(0.02, 0.2), (0.15,0.25)], -1, "IP OUTPUT HOLDOFF", horizontal=True),
+    Cam(1000, 100, [(0.02, 0.2), (0.15,0.25)], -1, "IP OUTPUT HOLDOFF", horizontal=True, holdoff=True),
 
     # Cam 12: Fires main memory injector, injecting all 8 columns. If STO is on, this diverts to the subtractor reader. If not, it
     # will fall through the memory and be discarded.
@@ -69,4 +71,39 @@ cams = [
 
 ]
 
+# Physics quality through the cycle. Bearings only move quickly for a
+# while after the bumps which release them, so continuous collision
+# (time of impact) is only worth its cost then. Each SolverPhase covers
+# simulation_time from start to end (0 to 1); the rest of the cycle uses
+# quiet_solver, which also runs fewer iterations. The busy phases keep
+# the usual 8 and 3: the machine is tuned to them, and more iterations
+# doesn't make it any more reliable. The schedule was only tuned with
+# motor driven cams: with kinematic cams as well, test 6 gets the wrong
+# accumulator, so the two can't be used together.
+SolverPhase = namedtuple("SolverPhase", field_names = ["start", "end", "velocity_iterations", "position_iterations", "continuous"])
+
+quiet_solver = SolverPhase(0.0, 1.0, 4, 2, False)
+
+solver_schedule = [
+    # PC INJECTOR and the first SENDER EJECT: the PC is read and the instruction row falls
+    SolverPhase(0.0, 0.10, 8, 3, True),
+    # TO INSTRUCTION REGISTER and the second SENDER EJECT: the operand row falls
+    SolverPhase(0.28, 0.36, 8, 3, True),
+    # UPPER REGEN, the instruction triggers, MAIN INJECTOR and DISCARD: execute and STO
+    SolverPhase(0.56, 0.82, 8, 3, True),
+    # INC PC, LOWER REGEN and MEMORY RETURN: the PC increments and memory is written back
+    SolverPhase(0.85, 1.0, 8, 3, True),
+]
 
+def solver_phase(simulation_time, schedule=solver_schedule):
+    """ The SolverPhase to use at simulation_time (0 to 1) in the cycle. """
+    for phase in schedule:
+        if phase.start <= simulation_time < phase.end:
+            return phase
+    return quiet_solver
+
+def last_active_bump_end(cam_list=cams):
+    """ The point in the cycle (0 to 1) at which the last bump of any cam
+    that moves data ends. Nothing changes the machine's state after this
+    apart from bearings still on their way. """
+    return max(start+length for c in cam_list if not c.holdoff for (start, length) in c.steps)
@@ -14,6 +14,11 @@ follower_spacing = 14
 memory_col0_x = 7
 memory_row0_y = -30
 
+# The fake ball lift: anything falling below lift_y is returned to the hopper
+lift_y = -650
+hopper_x = -50
+hopper_y = 250
+
 
 # Instruction format for the 8-bit machine: least significant 5 bits are address; top 3 bits are instruction.
 # Instructions are:
@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 
+import argparse
+import array
 import logging
+import os
 import random
+import time
+from collections import namedtuple
+
+import numpy as np
 
 from constants import *
 
@@ -11,7 +18,54 @@ from constants import *
 # will not work in the Box2D version, so we set 'unsupported_flag' which we emulate this. We also
 # don't implement opcode 5 (the second SUB instruction) or HLT.
 
-logging.basicConfig(level=logging.INFO)
+# Tracing: set SSEM_State.trace to a Trace to record every instruction
+# executed. Unlike logging, this doesn't format anything, and when trace
+# is None (the default) advance does no tracing work at all.
+
+trace_dtype = np.dtype([("pc", np.int64), ("instruction", np.int64), ("op", np.int8), ("address", np.int64),
+                        ("accumulator", np.int64), ("stored_address", np.int64), ("stored_value", np.int64)])
+
+class Trace():
+    """ A ring buffer holding the last 'capacity' instructions executed.
+    Each record is the PC and instruction word fetched, its opcode and
+    (wrapped) operand address, the accumulator after executing it, and
+    the memory address and value written, or -1 if nothing was stored. """
+    def __init__(self, capacity=65536):
+        # Storing a tuple in a list is much quicker than writing a row of
+        # a NumPy array, so records only become an array when read out.
+        self.buffer = [None] * capacity
+        self.count = 0
+
+    def record(self, pc, instruction, op, address, accumulator, stored_address, stored_value):
+        self.buffer[self.count % len(self.buffer)] = (pc, instruction, op, address, accumulator, stored_address, stored_value)
+        self.count += 1
+
+    def records(self):
+        """ The recorded instructions, oldest first, as a NumPy array with trace_dtype. """
+        capacity = len(self.buffer)
+        if self.count <= capacity:
+            records = self.buffer[:self.count]
+        else:
+            start = self.count % capacity
+            records = self.buffer[start:] + self.buffer[:start]
+        return np.array(records, dtype=trace_dtype)
+
+    def save(self, filename):
+        """ Writes the recorded instructions to a .npy file. """
+        np.save(filename, self.records())
+
+def load_trace(filename):
+    """ Reads the records saved by Trace.save. """
+    return np.load(filename)
+
+def executed_ops(state, cycles):
+    """ The names of the opcodes 'state' executes in its next 'cycles'
+    instructions, in order. 'state' is not changed. """
+    s = state.clone()
+    s.trace = Trace(cycles)
+    for i in range(0, cycles):
+        s.advance()
+    return [instruction_opcodes[op] for op in s.trace.records()["op"]]
 
 def twos_comp(num):
     if num < 0:
@@ -19,14 +73,61 @@ def twos_comp(num):
     return num
 
 class SSEM_State():
+    """ One emulated machine. Memory is an array which is shared with any
+    clones of this state until one of them writes to it, so clone() costs
+    the same however big the memory is. Assigning to 'mem' copies the
+    given words, and reading it gives a new list of them, so neither
+    unshares the memory; only a store does. """
+    __slots__ = ("pc", "accumulator", "unsupported_flag", "trace", "_mem", "_shared")
+
     def __init__(self):
         self.pc = 0
-        self.mem = [0] * memory_rows
+        self._mem = array.array('q', [0] * memory_rows)
+        self._shared = False
         self.accumulator = 0
         self.unsupported_flag = False # This is switched on if an unsupported opcode is used.
+        self.trace = None
+
+    @property
+    def mem(self):
+        return list(self._mem)
+
+    @mem.setter
+    def mem(self, words):
+        self._mem = array.array('q', words)
+        self._shared = False
+
+    def unshare(self):
+        """ Takes a private copy of the memory if it may be shared with a clone. """
+        if self._shared:
+            self._mem = array.array('q', self._mem)
+            self._shared = False
+
+    def clone(self):
+        """ Returns a copy of this state. Memory is only copied when either
+        copy next writes to it. Any trace is shared by both. """
+        s = SSEM_State.__new__(SSEM_State)
+        s.pc = self.pc
+        s.accumulator = self.accumulator
+        s.unsupported_flag = self.unsupported_flag
+        s.trace = self.trace
+        s._mem = self._mem
+        s._shared = self._shared = True
+        return s
+
+    def __copy__(self):
+        return self.clone()
+
+    def __deepcopy__(self, memo):
+        return self.clone()
+
     def advance(self):
-        logging.info("Initial mem={} PC == {}".format(",".join(map(str, self.mem)), self.pc))
-        instruction = self.mem[self.pc]
+        mem = self._mem
+        verbose = logging.root.isEnabledFor(logging.INFO)
+        if verbose:
+            logging.info("Initial mem={} PC == {}".format(",".join(map(str, mem)), self.pc))
+        start_pc = self.pc
+        instruction = mem[self.pc]
         if memory_columns == 32:
             instruction_address = instruction & ((1 << 13)-1)
             instruction_op = (instruction >> 13) & 7
@@ -35,27 +136,29 @@ class SSEM_State():
             instruction_op = (instruction >> 5) & 7
         else:
             raise Exception("Memory widths other than 8 or 32 are not supported.")
-        logging.info("Executing {}: {} on address {} (wrapped to {})".format(instruction, instruction_opcodes[instruction_op], instruction_address, instruction_address % memory_rows))
+        if verbose:
+            logging.info("Executing {}: {} on address {} (wrapped to {})".format(instruction, instruction_opcodes[instruction_op], instruction_address, instruction_address % memory_rows))
 
         if instruction_op == SB2 or instruction_op == HLT:
-            logging.warn("Executing unsupported {} opcode.".format(instruction_opcodes[instruction_op]))
+            logging.warning("Executing unsupported {} opcode.".format(instruction_opcodes[instruction_op]))
             self.unsupported_flag = True
 
         if instruction_op == JMP:
-            self.pc = self.mem[instruction_address % memory_rows]
+            self.pc = mem[instruction_address % memory_rows]
         elif instruction_op == JRP:
-            self.pc += self.mem[instruction_address % memory_rows]
+            self.pc += mem[instruction_address % memory_rows]
             self.pc %= memory_rows
         elif instruction_op == LDN:
-            self.accumulator = twos_comp(-self.mem[instruction_address % memory_rows])
+            self.accumulator = twos_comp(-mem[instruction_address % memory_rows])
         elif instruction_op == STO:
-            self.mem[instruction_address % memory_rows] = self.accumulator & ((2<<memory_columns)-1)
+            self.unshare()
+            self._mem[instruction_address % memory_rows] = self.accumulator & ((2<<memory_columns)-1)
         elif instruction_op == SUB or instruction_op == SB2:
-            self.accumulator = twos_comp(self.accumulator - self.mem[instruction_address % memory_rows])
+            self.accumulator = twos_comp(self.accumulator - mem[instruction_address % memory_rows])
         elif instruction_op == CMP:
-            mem_value = self.mem[instruction_address % memory_rows]
+            mem_value = mem[instruction_address % memory_rows]
             if mem_value != 0:
-                logging.warn("Executing CMP with non-zero operand")
+                logging.warning("Executing CMP with non-zero operand")
                 self.unsupported_flag = True
             if (self.accumulator & 0x80) == 0x80:
                 self.pc += 1
@@ -66,21 +169,326 @@ class SSEM_State():
             self.pc -= 1
         self.pc += 1
         self.pc %= memory_rows
+        if self.trace is not None:
+            if instruction_op == STO:
+                stored_address = instruction_address % memory_rows
+                stored_value = self._mem[stored_address]
+            else:
+                stored_address = stored_value = -1
+            self.trace.record(start_pc, instruction, instruction_op, instruction_address % memory_rows, self.accumulator, stored_address, stored_value)
+
+    def key(self):
+        """ The PC, accumulator and memory, as something which can be compared. """
+        return (self.pc, self.accumulator, self._mem.tobytes())
+
+    def find_loop(self, max_steps=1000000):
+        """ Advances this state until it returns to a state (PC,
+        accumulator and memory) it has been in before, or for 'max_steps'
+        instructions. Returns a Loop with entry_step counted from where
+        this state started, or None if it didn't repeat.
+
+        This follows advance() rather than SSEM_Machine.run, so the same
+        program can end differently: HLT doesn't halt, it repeats, so it
+        is found as a loop of period 1 entered at the HLT, where
+        SSEM_Machine stops with 'halted' set and no loop. SB2 is a second
+        SUB in both, and CMP skips on a negative accumulator whatever its
+        operand in both, but here either one also sets unsupported_flag.
+        Like SSEM_Machine.run, it uses Brent's algorithm. """
+        start = self.clone()
+        start.trace = None
+        saved = self.key()
+        power = 1
+        distance = 0
+        for i in range(0, max_steps):
+            self.advance()
+            distance += 1
+            if self.key() == saved:
+                break
+            if distance == power:
+                saved = self.key()
+                power *= 2
+                distance = 0
+        else:
+            return None
+        # Run two copies 'distance' instructions apart until they meet
+        first = start
+        second = start.clone()
+        for i in range(0, distance):
+            second.advance()
+        entry = 0
+        while first.key() != second.key():
+            first.advance()
+            second.advance()
+            entry += 1
+        return Loop(entry_step=entry, entry_pc=first.pc, period=distance)
+
     def __str__(self):
-        return "IP:%2.2X ACC:%8.8X  %s"%(self.pc, twos_comp(self.accumulator), " ".join("%8.8X"%twos_comp(x) for x in self.mem))
+        return "IP:%2.2X ACC:%8.8X  %s"%(self.pc, twos_comp(self.accumulator), " ".join("%8.8X"%twos_comp(x) for x in self._mem))
 
     def set_random(self):
         self.pc = random.randint(0,memory_rows-1)
         self.mem = [random.randint(0,255) for i in range(0,memory_rows)]
         self.accumulator = random.randint(0,(1<<memory_columns)-1)
         
+# A complete SSEM interpreter. Unlike SSEM_State, which is limited to what
+# the Box2D machine can do, this runs every instruction: SB2 is a second
+# SUB, CMP skips whenever the accumulator is negative and HLT stops the
+# machine. It's meant for running real SSEM programs quickly, so by
+# default it has a 32x32 store and it does no logging or tracing.
+
+def instruction_format(columns):
+    """ Returns (opcode shift, address mask) for a given word width. """
+    if columns == 32:
+        return (13, (1 << 13)-1)
+    elif columns == 8:
+        return (5, (1 << 5)-1)
+    raise Exception("Memory widths other than 8 or 32 are not supported.")
+
+def assemble(text, rows=32, columns=32):
+    """ Turns an SSEM program into a list of 'rows' memory words. Each line
+    is an instruction mnemonic (from instruction_opcodes, or STP for HLT)
+    and an address, or NUM and a value. A line may start with a line
+    number and a colon; anything after ';' is a comment. """
+    (shift, address_mask) = instruction_format(columns)
+    mnemonics = dict((name, op) for (op, name) in enumerate(instruction_opcodes))
+    mnemonics["STP"] = HLT
+    mem = [0] * rows
+    line_number = 0
+    for line in text.splitlines():
+        line = line.split(";")[0].strip()
+        if not line:
+            continue
+        if ":" in line:
+            (number, line) = line.split(":", 1)
+            line_number = int(number)
+        fields = line.split()
+        if fields[0].upper() == "NUM":
+            word = int(fields[1], 0)
+        else:
+            address = int(fields[1], 0) if len(fields) > 1 else 0
+            word = (mnemonics[fields[0].upper()] << shift) | (address & address_mask)
+        mem[line_number] = word & ((1 << columns)-1)
+        line_number += 1
+    return mem
+
+# Where a run settled into a repeating cycle: the total step count and PC
+# at which the machine first entered it, and its length in instructions.
+Loop = namedtuple("Loop", field_names = ["entry_step", "entry_pc", "period"])
+
+def row_hash(address, value):
+    return hash((address, value))
+
+class SSEM_Machine():
+    """ A fast SSEM interpreter. Memory words and the accumulator are kept
+    as unsigned integers of 'columns' bits. The PC follows SSEM_State: it
+    holds the address of the next instruction to run. """
+    def __init__(self, mem=None, pc=0, accumulator=0, rows=32, columns=32):
+        self.rows = rows
+        self.columns = columns
+        self.word_mask = (1 << columns)-1
+        (self.shift, self.address_mask) = instruction_format(columns)
+        self.mem = [0] * rows
+        if mem is not None:
+            self.mem[:len(mem)] = [m & self.word_mask for m in mem]
+        self.pc = pc % rows
+        self.accumulator = accumulator & self.word_mask
+        self.halted = False
+        self.loop = None
+        self.steps = 0
+        # The decode table holds (opcode, operand address) for each
+        # row. It's built once and kept up to date by STO.
+        self.decoded = [self.decode(word) for word in self.mem]
+
+    @classmethod
+    def from_state(cls, state, rows=memory_rows, columns=memory_columns):
+        return cls(state.mem, state.pc, state.accumulator, rows, columns)
+
+    def decode(self, word):
+        return ((word >> self.shift) & 7, (word & self.address_mask) % self.rows)
+
+    def store(self, address, value):
+        self.mem[address] = value & self.word_mask
+        self.decoded[address] = self.decode(self.mem[address])
+
+    def memory_hash(self):
+        """ A hash of the memory contents, which run updates on each STO. """
+        h = 0
+        for (address, value) in enumerate(self.mem):
+            h ^= row_hash(address, value)
+        return h
+
+    def run(self, max_steps=1000000, detect_loops=False):
+        """ Runs until the machine halts or 'max_steps' instructions have
+        been executed. Returns the number of instructions executed.
+
+        With detect_loops, it also stops if the machine returns to a state
+        (PC, accumulator and memory) it has been in before during this
+        run, since it will then repeat forever. self.loop is set to a Loop
+        describing the cycle. This uses Brent's algorithm, so it costs
+        very little and needs only one saved state. SSEM_State.find_loop
+        does the same for the Box2D machine's instruction set. """
+        if self.halted or self.loop is not None:
+            return 0
+        mem = self.mem
+        decoded = self.decoded
+        rows = self.rows
+        mask = self.word_mask
+        sign = 1 << (self.columns-1)
+        decode = self.decode
+        pc = self.pc
+        acc = self.accumulator
+        steps = max_steps
+        if detect_loops:
+            start = (pc, acc, list(mem))
+            mem_hash = self.memory_hash()
+            # The saved state, which is moved on to the current state after
+            # 1, 2, 4, 8... steps until a repeat of it is seen
+            saved = (pc, acc, mem_hash)
+            saved_mem = list(mem)
+            power = 1
+            distance = 0
+        # The opcodes are tested in rough order of frequency in real programs
+        for i in range(0, max_steps):
+            (op, address) = decoded[pc]
+            if op == SUB or op == SB2:
+                acc = (acc - mem[address]) & mask
+            elif op == LDN:
+                acc = (-mem[address]) & mask
+            elif op == STO:
+                if detect_loops:
+                    mem_hash ^= row_hash(address, mem[address]) ^ row_hash(address, acc)
+                mem[address] = acc
+                decoded[address] = decode(acc)
+            elif op == CMP:
+                if acc & sign:
+                    pc += 1
+            elif op == JMP:
+                pc = mem[address]
+            elif op == JRP:
+                pc += mem[address]
+            else:
+                # HLT: stop with the PC on the HLT instruction
+                self.halted = True
+                steps = i + 1
+                break
+            pc = (pc + 1) % rows
+            if detect_loops:
+                distance += 1
+                # Compare the whole memory only if the hashes match
+                if (pc, acc, mem_hash) == saved and mem == saved_mem:
+                    self.loop = self.find_loop_entry(start, distance)
+                    steps = i + 1
+                    break
+                if distance == power:
+                    saved = (pc, acc, mem_hash)
+                    saved_mem[:] = mem
+                    power *= 2
+                    distance = 0
+        self.pc = pc
+        self.accumulator = acc
+        if self.loop is not None:
+            self.loop = self.loop._replace(entry_step = self.steps + self.loop.entry_step)
+        self.steps += steps
+        return steps
+
+    def find_loop_entry(self, start, period):
+        """ Given the state at the start of a run and the period of the cycle
+        it ended in, finds where the cycle starts by running two copies
+        'period' instructions apart until they meet. Returns a Loop with
+        entry_step relative to the start of the run. """
+        (pc, acc, mem) = start
+        first = SSEM_Machine(mem, pc, acc, self.rows, self.columns)
+        second = SSEM_Machine(mem, pc, acc, self.rows, self.columns)
+        second.run(period)
+        entry = 0
+        while (first.pc, first.accumulator, first.mem) != (second.pc, second.accumulator, second.mem):
+            first.run(1)
+            second.run(1)
+            entry += 1
+        return Loop(entry_step=entry, entry_pc=first.pc, period=period)
+
+    def step(self):
+        """ Executes one instruction, unless halted. """
+        return self.run(1)
+
+    def state(self):
+        """ Returns an SSEM_State with the same registers and memory. """
+        s = SSEM_State()
+        s.pc = self.pc
+        s.mem = list(self.mem)
+        s.accumulator = self.accumulator
+        return s
+
+# Counts the number in line 20 down to -1, then halts. Used for benchmarking.
+countdown_program = """
+ 0: LDN 20  ; A = -x
+    STO 21
+    LDN 21  ; A = x
+    SUB 22  ; A = x - 1
+    STO 20
+    CMP     ; Skip the jump once x is negative
+    JMP 23  ; Back to line 0
+    STP
+20: NUM 0
+21: NUM 0
+22: NUM 1
+23: NUM -1
+"""
+
+def machine_benchmark(count, detect_loops=False):
+    """ Runs countdown_program from 'count'. Returns (instructions, seconds). """
+    machine = SSEM_Machine(assemble(countdown_program))
+    machine.store(20, count)
+    start = time.time()
+    while not machine.halted:
+        machine.run(detect_loops=detect_loops)
+    return (machine.steps, time.time() - start)
+
+def benchmark(steps, log=False, trace=None):
+    """ Runs 'steps' instructions from a random state and returns the time taken.
+    Unsupported opcodes don't matter here; the machine carries on. """
+    # The same starting state each time, so the results are comparable
+    random.seed(1)
+    state = SSEM_State()
+    state.set_random()
+    state.trace = trace
+    level = logging.root.level
+    logging.root.setLevel(logging.INFO if log else logging.ERROR)
+    start = time.time()
+    for i in range(0, steps):
+        state.advance()
+    elapsed = time.time() - start
+    logging.root.setLevel(level)
+    return elapsed
+
 def main():
+    parser = argparse.ArgumentParser(description="Run the SSEM emulator on a random state.")
+    parser.add_argument('--benchmark', type=int, metavar="STEPS", help="Measure SSEM_State steps per second with logging, without tracing and with tracing, and SSEM_Machine's speed")
+    parser.add_argument('--trace', help="Save a trace of the instructions executed to this .npy file")
+    parser.add_argument('--steps', type=int, default=1, help="Instructions to run")
+    args = parser.parse_args()
+    if args.benchmark:
+        # The log messages themselves would swamp the measurement
+        logging.basicConfig(level=logging.INFO, stream=open(os.devnull, "w"))
+        for (name, log, trace) in [("logging on", True, None), ("tracing off", False, None), ("tracing on", False, Trace())]:
+            elapsed = benchmark(args.benchmark, log, trace)
+            print("{:12} {:.0f} steps/s".format(name+":", args.benchmark / elapsed))
+        for (name, detect_loops) in [("SSEM_Machine:", False), ("with loop detection:", True)]:
+            (steps, elapsed) = machine_benchmark(args.benchmark, detect_loops)
+            print("{:12} {:.0f} steps/s".format(name, steps / elapsed))
+        return
+    logging.basicConfig(level=logging.INFO)
     startstate = SSEM_State()
-    # Put the machine in a random state and run one cycle
+    if args.trace:
+        startstate.trace = Trace()
+    # Put the machine in a random state and run it
     startstate.set_random()
     print(startstate)
-    startstate.advance()
+    for i in range(0, args.steps):
+        startstate.advance()
     print(startstate)
+    if args.trace:
+        startstate.trace.save(args.trace)
     
 if __name__=="__main__":
     main()
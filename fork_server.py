@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Fork server for high-volume headless test runs.
+
+# Importing Box2D and building the machine is a large part of the cost
+# of a short test. This builds and settles one Memory in a long-lived
+# process and then forks a child for each test vector. The children share
+# the constructed world copy-on-write; each one loads its own memory,
+# accumulator and PC, runs to completion and reports the verify_results
+# code back over a pipe.
+#
+# Test vectors are read from stdin, one per line, as 'test <number>' or
+# 'random <seed>'. One JSON result line is written to stdout per test.
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import select
+import signal
+import sys
+import time
+
+from main import result_record
+from run_tests import job_cycles
+
+def build_machine(kinematic_cams=False, time_scale=1.0, solver_scheduling=False):
+    """ Builds and settles a machine with no test loaded. """
+    from main import Memory
+    machine = Memory(False, False, 0, True, use_snapshot=True, build_only=True, kinematic_cams=kinematic_cams, time_scale=time_scale)
+    machine.solver_scheduling = solver_scheduling
+    return machine
+
+def run_child(machine, job, write_fd, quiet):
+    """ Runs in the forked child: loads and runs one test, writes the result to write_fd and exits. """
+    (kind, number) = job
+    if quiet:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    # Otherwise every child would inherit the same start point jitter
+    random.seed()
+    try:
+        machine.select_test(kind == "test", kind == "random", number)
+        machine.run()
+        r = machine.run_result()
+        sys.stdout.flush()
+        # The server fills in the times, which it measures itself
+        report = result_record(kind, number, r, "kinematic" if machine.kinematic_cams else "motor", machine.time_scale)
+        os.write(write_fd, (json.dumps(report)+"\n").encode())
+    finally:
+        # Never return into the server's loop, even on an exception
+        os._exit(0)
+
+def read_all(fd):
+    data = b""
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk: break
+        data += chunk
+    os.close(fd)
+    return data
+
+def run_jobs(jobs, max_children=None, quiet=True, machine=None):
+    """ Runs each (kind, number) job in 'jobs' in a forked child, at most
+    max_children at once. Yields one result record per job, in order of
+    completion, in the same format as run_tests.run_one. """
+    if max_children is None:
+        max_children = os.cpu_count()
+    if machine is None:
+        machine = build_machine()
+    jobs = iter(jobs)
+    running = {}
+    try:
+        yield from wait_for_jobs(jobs, running, max_children, quiet, machine)
+    finally:
+        # If the caller stops early, don't leave children running
+        for (pid, (job, read_fd, start)) in running.items():
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+
+def wait_for_jobs(jobs, running, max_children, quiet, machine):
+    """ The body of run_jobs. 'running' maps the pid of each child to its
+    (job, pipe, start time), so that run_jobs can clean up. """
+    more_jobs = True
+    while more_jobs or running:
+        while more_jobs and len(running) < max_children:
+            job = next(jobs, None)
+            if job is None:
+                more_jobs = False
+                break
+            (read_fd, write_fd) = os.pipe()
+            # Anything left in our buffers would otherwise be printed again by the child
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                run_child(machine, job, write_fd, quiet)
+            os.close(write_fd)
+            running[pid] = (job, read_fd, time.time())
+        if not running:
+            break
+        # Read a report to the end before reaping its child: a child whose
+        # report doesn't fit in the pipe can't exit until it's been read
+        children = dict((read_fd, pid) for (pid, (job, read_fd, start)) in running.items())
+        (ready, _, _) = select.select(list(children), [], [])
+        pid = children[ready[0]]
+        (job, read_fd, start) = running.pop(pid)
+        data = read_all(read_fd)
+        (pid, status, usage) = os.wait4(pid, 0)
+        if data:
+            record = json.loads(data.decode())
+        else:
+            record = result_record(job[0], job[1], None, "kinematic" if machine.kinematic_cams else "motor",
+                                   machine.time_scale, cycles=job_cycles(*job))
+        record["wall_time"] = time.time() - start
+        record["cpu_time"] = usage.ru_utime + usage.ru_stime
+        yield record
+
+def parse_job(line):
+    (kind, number) = line.split()
+    if kind not in ("test", "random"):
+        raise ValueError("Unknown test kind '{}'".format(kind))
+    return (kind, int(number))
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the SSEM once and fork a child per test read from stdin.")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Maximum number of children at once")
+    parser.add_argument('--verbose', action='store_true', help="Let children print their progress")
+    parser.add_argument('--kinematic-cams', action='store_true', help="Turn the cams at a fixed rate instead of driving them with motors")
+    parser.add_argument('--solver-schedule', action='store_true', help="Change solver settings through each cycle as set out in cams.solver_schedule")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Run the machine this many times faster; see Memory.compress_time")
+    args = parser.parse_args()
+    if args.time_scale <= 0:
+        parser.error("--time-scale must be greater than 0")
+    if args.kinematic_cams and args.solver_schedule:
+        parser.error("--solver-schedule can't be used with --kinematic-cams")
+    with contextlib.redirect_stdout(sys.stderr):
+        machine = build_machine(args.kinematic_cams, args.time_scale, args.solver_schedule)
+    # Server messages go to stderr, leaving stdout for results
+    print("Machine built; reading tests from stdin", file=sys.stderr)
+    jobs = (parse_job(line) for line in sys.stdin if line.strip())
+    for record in run_jobs(jobs, args.jobs, quiet=not args.verbose, machine=machine):
+        print(json.dumps(record))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
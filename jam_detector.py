@@ -0,0 +1,149 @@
+# Jam and stall detection for the Box2D SSEM.
+
+# A lever that wedges or a bearing that lodges in a channel doesn't stop
+# the simulation; the run just carries on to the end of its last cycle and
+# then fails. JamDetector watches the running machine for the signs of a
+# jam and reports the first one it finds, naming the stuck body and where
+# it is, so the run can be abandoned straight away:
+#
+# * A cam whose drive has fallen well behind the angle it's being driven to,
+#   because something it pushes can't move.
+# * A cam follower held clear of its cam's surface for much longer than
+#   the cam profile or any lever it shares could account for.
+# * A ball bearing which has stopped moving anywhere other than a memory
+#   cell or one of the machine's resting regions (hoppers and reservoirs).
+# * The machine's total kinetic energy going over a fixed limit, far above
+#   anything a working machine reaches, which is how Box2D usually
+#   responds to bodies being forced into each other.
+#
+# The limits are set well clear of anything seen in passing runs. Times
+# and speeds are for a machine at time_scale 1, and are scaled to suit the
+# machine's time_scale (see Memory.compress_time).
+
+import math
+from collections import namedtuple
+
+import numpy as np
+from Box2D import b2_dynamicBody
+
+# A detected jam. 'kind' is one of "cam", "follower", "bearing" or
+# "energy"; 'body' names the stuck part and 'position' is its (x, y) in
+# machine units.
+Jam = namedtuple("Jam", field_names = ["kind", "body", "position", "message"])
+
+check_interval = 50 # Ticks between checks
+
+cam_lag_limit = 0.3 # Radians behind the target angle; passing runs stay under 0.06
+cam_lag_ticks = 200
+
+follower_clearance_limit = 2.5 # Units above the cam profile; smaller than any bump
+# Some followers share a lever with an instruction output (DISCARD moves
+# with STO, for example) and are lifted clear while it's selected, so this
+# is longer than any bump in the cam table.
+follower_clearance_ticks = 3000
+
+bearing_still_speed = 2.0 # Units per second
+bearing_still_ticks = 5000
+
+# About ten times the highest total seen in passing runs: 5.7e9, the peak
+# over the 24 of prewritten tests 0-7 and random tests 1-20 which passed
+energy_limit = 6e10
+
+class JamDetector():
+    """ Watches a Memory (the Box2D SSEM) for jams. Call check() every
+    check_interval ticks while the cams are turning. """
+    def __init__(self, machine):
+        self.machine = machine
+        s = machine.time_scale
+        self.cam_lag_ticks = machine.scaled_ticks(cam_lag_ticks)
+        self.follower_clearance_ticks = machine.scaled_ticks(follower_clearance_ticks)
+        self.bearing_still_ticks = machine.scaled_ticks(bearing_still_ticks)
+        self.bearing_still_speed = bearing_still_speed*s
+        self.energy_limit = energy_limit*s*s
+        self.cam_lag = np.zeros(len(machine.all_cam_drives), dtype=int)
+        self.follower_clear = np.zeros(len(machine.cam_followers), dtype=int)
+        self.bearing_still = np.zeros(len(machine.ball_bearings), dtype=int)
+
+    def check(self, target_angle):
+        """ Checks the machine, whose cams are being driven to
+        target_angle. Returns a Jam, or None if nothing is stuck. """
+        return (self.check_cams(target_angle) or self.check_followers()
+                or self.check_bearings() or self.check_energy())
+
+    def check_cams(self, target_angle):
+        m = self.machine
+        lag = np.array([target_angle - d.angle for d in m.all_cam_drives])
+        self.cam_lag = np.where(np.abs(lag) > cam_lag_limit, self.cam_lag + check_interval, 0)
+        worst = int(np.argmax(self.cam_lag))
+        if self.cam_lag[worst] >= self.cam_lag_ticks:
+            d = m.all_cam_drives[worst]
+            position = (d.anchorA.x/m.scale, d.anchorA.y/m.scale)
+            return Jam("cam", "cam {}".format(m.cam_names[worst]), position,
+                       "{:.2f} radians behind its drive for {} ticks".format(lag[worst], self.cam_lag[worst]))
+        return None
+
+    def follower_clearance(self, follower):
+        """ How far the follower's wheel is above the surface of its cam at the point they should touch. """
+        scale = self.machine.scale
+        centre = follower.cam.worldCenter
+        wheel = follower.wheel.worldCenter
+        (dx, dy) = ((wheel.x - centre.x)/scale, (wheel.y - centre.y)/scale)
+        # Bumps were laid out clockwise from the cam body's zero angle; see add_cam
+        turn = (-(math.atan2(dy, dx) - follower.cam.angle)/(2*math.pi)) % 1.0
+        # Allow for the ramps either side of each bump
+        on_bump = any((turn - start) % 1.0 <= length + 0.03 for (start, length) in follower.bumps)
+        wheel_radius = follower.wheel.fixtures[0].shape.radius/scale
+        surface = follower.radius + (follower.lift if on_bump else 0)
+        return math.hypot(dx, dy) - wheel_radius - surface
+
+    def check_followers(self):
+        m = self.machine
+        clearance = np.array([self.follower_clearance(f) for f in m.cam_followers])
+        self.follower_clear = np.where(clearance > follower_clearance_limit, self.follower_clear + check_interval, 0)
+        worst = int(np.argmax(self.follower_clear))
+        if self.follower_clear[worst] >= self.follower_clearance_ticks:
+            f = m.cam_followers[worst]
+            position = (f.wheel.worldCenter.x/m.scale, f.wheel.worldCenter.y/m.scale)
+            return Jam("follower", "follower of cam {}".format(f.name), position,
+                       "held {:.1f} units clear of its cam for {} ticks".format(clearance[worst], self.follower_clear[worst]))
+        return None
+
+    def check_bearings(self):
+        m = self.machine
+        state = m.capture_state()
+        speed = np.hypot(state.bearing_velocity[:,0], state.bearing_velocity[:,1])
+        x = state.bearing_position[:,0]
+        y = state.bearing_position[:,1]
+        resting = state.resting_bearings()
+        self.bearing_still = np.where((speed < self.bearing_still_speed) & ~resting, self.bearing_still + check_interval, 0)
+        worst = int(np.argmax(self.bearing_still))
+        if self.bearing_still[worst] >= self.bearing_still_ticks:
+            return Jam("bearing", "bearing {} (plane {})".format(worst, state.bearing_plane[worst]), (x[worst], y[worst]),
+                       "stopped outside any resting place for {} ticks".format(self.bearing_still[worst]))
+        return None
+
+    def check_energy(self):
+        m = self.machine
+        bodies = [b for b in m.world.bodies if b.awake and b.type == b2_dynamicBody]
+        energies = [0.5*b.mass*b.linearVelocity.lengthSquared + 0.5*b.inertia*b.angularVelocity**2 for b in bodies]
+        total = sum(energies)
+        if total > self.energy_limit:
+            b = bodies[int(np.argmax(energies))]
+            position = (b.worldCenter.x/m.scale, b.worldCenter.y/m.scale)
+            return Jam("energy", self.describe_body(b), position,
+                       "has {:.3g} of the machine's total kinetic energy of {:.3g}, over {:.3g}".format(max(energies), total, self.energy_limit))
+        return None
+
+    def describe_body(self, body):
+        """ A name for 'body' to use in diagnostics. """
+        m = self.machine
+        # Box2D hands out a new wrapper for each body every time, so compare with ==, not 'is'
+        for (i, (b, plane)) in enumerate(m.ball_bearings):
+            if b == body:
+                return "bearing {} (plane {})".format(i, plane)
+        for f in m.cam_followers:
+            if f.cam == body:
+                return "cam {}".format(f.name)
+            if f.wheel == body:
+                return "follower of cam {}".format(f.name)
+        return "body of mass {:.3g}".format(body.mass)
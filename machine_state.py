@@ -0,0 +1,119 @@
+# Whole-machine state readout for the Box2D SSEM.
+
+# Reading the machine used to mean walking every ball bearing once for
+# each memory cell. MachineState instead copies everything we care about
+# out of the world in one pass into preallocated NumPy arrays, and the
+# registers and memory are then decoded from those arrays.
+
+import numpy as np
+
+from constants import *
+
+def bits_to_value(bits):
+    """ Converts an array of bits, most significant first, to an integer. """
+    weights = 1 << np.arange(len(bits)-1, -1, -1)
+    return int(np.dot(bits, weights))
+
+class MachineState():
+    """ A snapshot of the dynamic state of a running Memory (the Box2D SSEM).
+
+    The arrays are allocated once when this is created; capture()
+    refreshes them in place from the world. All positions are in machine
+    units (i.e. already divided by the world scale).
+    """
+    def __init__(self, machine):
+        self.machine = machine
+        # Bearings are only added when a test is loaded, and a new MachineState is made then
+        self.bearing_bodies = [b for (b, plane) in machine.ball_bearings]
+        n = len(self.bearing_bodies)
+        self.bearing_position = np.zeros((n,2))
+        self.bearing_angle = np.zeros(n)
+        self.bearing_velocity = np.zeros((n,2))
+        self.bearing_angular_velocity = np.zeros(n)
+        self.bearing_plane = np.zeros(n, dtype=np.int8)
+        self.accumulator_toggle_angle = np.zeros(len(machine.accumulator_toggles))
+        self.pc_toggle_angle = np.zeros(len(machine.ip_toggles))
+        self.cam_angle = np.zeros(len(machine.all_cam_drives))
+        self.cam_speed = np.zeros(len(machine.all_cam_drives))
+        self.memory_sensor_y = np.zeros(len(machine.memory_sensors))
+
+    def capture(self):
+        """ Copies the current state of the world into the arrays. Returns self. """
+        m = self.machine
+        bodies = self.bearing_bodies
+        centres = [b.worldCenter for b in bodies]
+        velocities = [b.linearVelocity for b in bodies]
+        self.bearing_position[:] = [(c.x, c.y) for c in centres]
+        self.bearing_position /= m.scale
+        self.bearing_velocity[:] = [(v.x, v.y) for v in velocities]
+        self.bearing_velocity /= m.scale
+        self.bearing_angle[:] = [b.angle for b in bodies]
+        self.bearing_angular_velocity[:] = [b.angularVelocity for b in bodies]
+        self.bearing_plane[:] = [plane for (b, plane) in m.ball_bearings]
+        self.accumulator_toggle_angle[:] = [j.angle for j in m.accumulator_toggles]
+        self.pc_toggle_angle[:] = [j.angle for j in m.ip_toggles]
+        self.cam_angle[:] = [j.angle for j in m.all_cam_drives]
+        self.cam_speed[:] = [j.speed for j in m.all_cam_drives]
+        self.memory_sensor_y[:] = [s.worldCenter.y for s in m.memory_sensors]
+        self.memory_sensor_y /= m.scale
+        return self
+
+    def accumulator_bits(self):
+        """ Accumulator bits, most significant first. """
+        return np.where(self.accumulator_toggle_angle > 0, 0, 1)
+
+    def accumulator_value(self):
+        return bits_to_value(self.accumulator_bits())
+
+    def pc_bits(self):
+        """ Program counter bits, most significant first. """
+        return np.where(self.pc_toggle_angle > 0, 1, 0)
+
+    def pc_value(self):
+        return bits_to_value(self.pc_bits())
+
+    def instruction_bits(self):
+        """ Instruction register bits (the memory sender sensors), most significant first. """
+        return np.where(self.memory_sensor_y - self.machine.memory_sender_y > 2, 1, 0)
+
+    def instruction_value(self):
+        return bits_to_value(self.instruction_bits())
+
+    def memory_cells(self):
+        """ Bins each bearing to its nearest memory cell. Returns arrays of
+        (row, column, inside) where 'inside' is true for bearings within 5
+        units of that cell's resting position. """
+        x = self.bearing_position[:,0]
+        y = self.bearing_position[:,1]
+        col = np.rint(7 - (x - memory_col0_x) / pitch)
+        row = np.rint((y - memory_row0_y - 40) / 14)
+        dx = memory_col0_x + pitch*(7-col) - x
+        dy = memory_row0_y + 14*row + 40 - y
+        inside = (np.abs(dx) < 5) & (np.abs(dy) < 5) & (col >= 0) & (col < memory_columns) & (row >= 0) & (row < memory_rows)
+        return (row.astype(int), col.astype(int), inside)
+
+    def resting_bearings(self):
+        """ True for each bearing which is somewhere it can stay put: in a
+        memory cell, in one of the machine's resting regions (see
+        Memory.regions) or parked outside the machine. """
+        m = self.machine
+        x = self.bearing_position[:,0]
+        y = self.bearing_position[:,1]
+        (row, col, resting) = self.memory_cells()
+        for r in m.regions:
+            if r.resting:
+                resting |= (x >= r.left) & (x <= r.right) & (y >= r.bottom) & (y <= r.top)
+        resting[m.spare_bearings] = True
+        return resting
+
+    def memory_array(self):
+        """ Returns the memory contents as a list of row values. """
+        (row, col, inside) = self.memory_cells()
+        memory = np.zeros(memory_rows, dtype=np.int64)
+        np.add.at(memory, row[inside], np.left_shift(1, col[inside]))
+        return memory.tolist()
+
+    def memory_bearings(self):
+        """ Indices (into ball_bearings) of the bearings sitting in memory cells. """
+        (row, col, inside) = self.memory_cells()
+        return np.flatnonzero(inside).tolist()
@@ -19,18 +19,31 @@
 
 
 import argparse
+import contextlib
 import copy
+import json
+import logging
+import os
 import math
 import random
 import sys
+import time
+from collections import namedtuple
+
+import numpy as np
 
 from Box2D.b2 import (edgeShape, circleShape, fixtureDef, polygonShape, filter)
-from Box2D import b2CircleShape
+from Box2D import b2CircleShape, b2_dynamicBody, b2_kinematicBody, b2RevoluteJoint, b2PrismaticJoint, b2DistanceJoint
 from constants import *
 from test_sets import test_set
-from emulator import SSEM_State
-from settings import fwSettings
-from cams import cams
+from emulator import SSEM_State, executed_ops, instruction_format
+from machine_state import MachineState
+from jam_detector import JamDetector, check_interval as jam_check_interval
+import bearing_ledger
+from bearing_ledger import BearingLedger
+import world_snapshot
+from settings import fwSettings, solver_profiles
+from cams import cams, last_active_bump_end, solver_phase, solver_schedule, quiet_solver
 def box_vertices(x, y, width,height):
     return [(x,y), (x+width,y), (x+width,y+height), (x,y+height)]
 
@@ -54,23 +67,145 @@ SUCCESS = 0
 WRONG_ACCUMULATOR = 1
 WRONG_IP = 2
 WRONG_MEMORY = 3
-UNSUPPORTED_OP = 0
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--test', action='store_true')
-    parser.add_argument('--randomtest', action='store_true')
-    parser.add_argument('--headless', action='store_true')
-    parser.add_argument('--overlay', action='store_true')
-    parser.add_argument('--timelapse', type=int, default=0)
-    parser.add_argument('testset', type=int, default=0, nargs='?')
-    args = parser.parse_args()
-    if args.headless:
-        from backends.headless_framework import HeadlessFramework as Framework
-    else:
-        from backends.modified_pygame_framework import ModifiedPygameFramework as Framework
+WRONG_INSTRUCTION = 4
+JAMMED = 5
+BEARINGS_LOST = 6
+# The test uses an operation the machine can't do, so it was skipped. This
+# is neither a pass nor a failure; main still exits with 0 for it.
+UNSUPPORTED_OP = 7
+
+result_names = { SUCCESS: "SUCCESS", WRONG_ACCUMULATOR: "WRONG_ACCUMULATOR", WRONG_IP: "WRONG_IP", WRONG_MEMORY: "WRONG_MEMORY",
+                 WRONG_INSTRUCTION: "WRONG_INSTRUCTION", JAMMED: "JAMMED",
+                 BEARINGS_LOST: "BEARINGS_LOST", UNSUPPORTED_OP: "UNSUPPORTED" }
+
+# Unused memory bearings are kept here, out of the machine, in session mode
+bearing_park_x = -5000
+bearing_park_y = 5000
+
+# Ticks to run a newly built machine for before saving it as a settled snapshot.
+settle_delay = 400
+
+# Automated tests start the cams once the machine has come to rest after
+# the toggles are reset: every dynamic body, other than the rake and
+# bearings sitting in memory or a hopper, has to stay under both speeds
+# for settle_window ticks in a row.
+settle_speed = 1.5 # Units per second
+settle_spin = 0.1 # Radians per second
+settle_window = 20
+settle_limit = 1000 # Start anyway after this many ticks
+# With start_jitter, the cams start up to this many ticks after that, at random.
+start_jitter_ticks = 100
+
+# Ticks per cycle, in which the cams make one turn. This and the other
+# tick counts here are for time_scale 1; a machine with a larger time_scale
+# scales them down with SSEM.scaled_ticks.
+cycle_ticks = 10000
+
+# Points in each cycle (out of cycle_ticks) at which the machine is
+# compared with the emulator, so that a failing test can stop early.
+instruction_check_point = 4400 # The instruction register has been loaded
+register_check_point = 9700 # The accumulator and PC have settled after execute
+# Written bearings land in their memory row at about tick 9650 and the
+# last bump ends at 9800; early in the next cycle (around ticks 250-320)
+# the fetch briefly disturbs the rows, so memory is checked in between.
+# bearing_ledger.cycle_end_point is the same point.
+memory_check_point = 9900 # This cycle's writeback has finished
+
+# Automated tests end as soon as the last bump which moves data in the
+# final cycle has finished (see cams.last_active_bump_end) and the
+# accumulator, PC and memory have not changed for early_end_window ticks,
+# rather than waiting for the cams to finish their turn.
+early_end_point = int(cycle_ticks*last_active_bump_end())
+early_end_window = 100
+early_end_interval = 25 # Ticks between readouts
+
+# The outcome of run_test or run_state. 'result' is one of the error codes
+# above; 'unsupported' is set (and nothing is run) if the emulator used an
+# operation the machine can't do. Registers and memory are as read from the
+# machine at the end of the run. 'jam' describes what stuck, for JAMMED.
+# 'ledger' is the list of BearingLedger entries and 'leaks' any bearing
+# conservation violations it found. Times are in seconds.
+RunResult = namedtuple("RunResult", field_names = ["result", "result_name", "unsupported",
+                                                   "accumulator", "pc", "memory",
+                                                   "initial_state", "expected_state", "cycles", "failed_phase", "jam", "ledger", "leaks",
+                                                   "early_end", "early_end_agrees", "solver_schedule", "solver_iterations",
+                                                   "ticks", "build_time", "run_time"])
+
+def result_record(kind, number, run_result, cam_drive, time_scale, wall_time=None, cpu_time=None, cycles=None):
+    """ The JSON record of one test, as written by run_tests.py, fork_server.py
+    and sessions. 'run_result' is the test's RunResult, or None if it never
+    reported one, in which case the record is an ERROR and 'cycles' gives
+    the length of the test. """
+    r = run_result
+    return { "kind": kind,
+             "number": number,
+             "exit_code": r.result if r else None,
+             "result": r.result_name if r else "ERROR",
+             "wall_time": wall_time,
+             "cpu_time": cpu_time,
+             "ticks": r.ticks if r else None,
+             "cycles": r.cycles if r else cycles,
+             "ops": executed_ops(r.initial_state, r.cycles) if r else None,
+             "failed_phase": r.failed_phase if r else None,
+             "jam": r.jam if r else None,
+             "ledger": r.ledger if r else None,
+             "leaks": r.leaks if r else None,
+             "early_end": r.early_end if r else None,
+             "solver_schedule": r.solver_schedule if r else None,
+             "solver_iterations": r.solver_iterations if r else None,
+             "cam_drive": cam_drive,
+             "time_scale": time_scale }
+
+# How an automated test is run, with the defaults. cross_check compares
+# the machine with the emulator during each cycle (see cross_check);
+# jam_detection stops runs which jam (see JamDetector); the bearing ledger
+# is taken at ledger_points in each cycle, and ledger_abort stops the run
+# as soon as a bearing goes missing; start_jitter delays the start by a
+# random amount after settling (see schedule_start); early_end finishes
+# once the results have been settled for early_end_window ticks (see
+# check_early_end), and early_end_check runs the whole turn anyway and
+# compares the verdicts; solver_scheduling changes the solver settings
+# through the cycle (see cams.solver_schedule). SSEM.use_options applies
+# them to a machine.
+RunOptions = namedtuple("RunOptions", field_names = ["cross_check", "jam_detection", "ledger_points", "ledger_abort",
+                                                     "start_jitter", "early_end", "early_end_check", "early_end_window",
+                                                     "solver_scheduling"],
+                        defaults = [True, True, bearing_ledger.default_points, False,
+                                    False, True, False, early_end_window,
+                                    False])
+
+# An invisible sensor region. Bearings whose centre enters it are flipped to
+# the other plane (source_plane 0 or 1) or, if source_plane is None, returned
+# to the hopper by the fake ball lift.
+SensorRegion = namedtuple("SensorRegion", field_names = ["top", "bottom", "left", "right", "source_plane"])
+
+class PhaseSettings():
+    """ Stands in for the framework settings during a cams.SolverPhase,
+    replacing the solver options and passing everything else through. """
+    def __init__(self, settings, phase):
+        self.__dict__["settings"] = settings
+        self.__dict__["velocityIterations"] = phase.velocity_iterations
+        self.__dict__["positionIterations"] = phase.position_iterations
+        self.__dict__["enableContinuous"] = phase.continuous
+
+    def __getattr__(self, name):
+        return getattr(self.settings, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.settings, name, value)
+
+# A named part of the machine, for counting bearings (see BearingLedger).
+# Bearings may come to rest in 'resting' regions, such as hoppers; in the
+# rest they should always be moving through.
+Region = namedtuple("Region", field_names = ["name", "left", "bottom", "right", "top", "resting"])
+
+# A cam and the wheel of its follower arm. 'bumps' are (start, length)
+# fractions of a turn, in the cam body's own frame, where the cam surface
+# is raised by 'lift' above its radius.
+CamFollower = namedtuple("CamFollower", field_names = ["name", "cam", "wheel", "radius", "bumps", "lift"])
 
 from framework import (main, Keys)
+from backends.headless_framework import HeadlessFramework
     
 class Parts():
     """ This is a container class for parts within the SSEM. Parts are filled in gradually during setup. """
@@ -86,7 +221,9 @@ class Parts():
         self.cmd_injector = None
         self.memory_follower_holdoff = None
 
-class Memory (Framework):
+class SSEM():
+    """ The whole machine. This is combined with a framework class (see
+    Memory and gui_memory_class) which provides the world and main loop. """
     name = "SSEM"
 
     def vertical_rotating_bar(self, xpos, ypos, height, attachment_body, support_sep=50):
@@ -175,6 +312,7 @@ class Memory (Framework):
                 self.transfer_bands.append((ypos-43+10, ypos-43, [(xpos+discard+3, xpos+discard+13)], 1))
             else:
                 self.add_static_polygon([(8*pitch,0), (discard,-30), (discard,-33), (8*pitch,-3) ], xpos, ypos-11, filterB)
+            self.regions.append(Region("discard path", min(xpos, xpos+discard), ypos-45, max(xpos+8*pitch, xpos+discard+15), ypos-11, False))
         elif slope_x!=0:
             if slope_x < 0:
                 offset = pitch
@@ -324,6 +462,13 @@ class Memory (Framework):
 
         self.slide_joint(attachment_body, reset_lever, (1,0), -20,20, friction=0.01)
 
+        name = "PC" if is_actually_adder else "accumulator"
+        top = ypos+pitch+9
+        bottom = ypos-sub_y_pitch*lines-10
+        for c in range(0,lines):
+            self.regions.append(Region("{} column {}".format(name, c), xpos+(c-0.5)*pitch, bottom, xpos+(c+0.5)*pitch, top, False))
+        self.regions.append(Region("{} reader".format(name), xpos+output_offset_x-pitch, bottom, xpos+output_offset_x+lines*pitch, top, False))
+
         # Transfer bands in negative reader channels (discards)
         if discard_bands:
             transfer_band_x = [ (xpos+output_offset_x+pitch*x-12,xpos+output_offset_x+pitch*x) for x in range(1,lines) ]
@@ -407,6 +552,8 @@ class Memory (Framework):
         
     def add_ball_bearing(self, xpos, ypos, plane):
         bearing = self.add_dynamic_circle(xpos, ypos, 6.35/2, density=5.0, filter=filters[plane], color=(255,0,0) if plane==0 else (127,0,0))
+        # The fixture's userData is the bearing's index, so sensor contacts can find it
+        bearing.fixtures[0].userData = len(self.ball_bearings)
         self.ball_bearings.append((bearing,plane))
         return bearing
 
@@ -569,6 +716,8 @@ class Memory (Framework):
         self.distance_joint(crank, blocker_set)
         blocker_set.attachment_point=(c*pitch+5,3)
         blocker_set.origin=(xpos, ypos)
+        # The instruction register holds its bearings for most of a cycle
+        self.regions.append(Region("instruction register", xpos-10, ypos-20, xpos+8*pitch+10, ypos+20, True))
         return blocker_set
     # Interface functions to PyBox2D
 
@@ -707,11 +856,12 @@ class Memory (Framework):
 	                                   anchorB=bodyB.worldCenter,
 	                                   collideConnected=False)
 
-    def add_cam(self, xpos, ypos, follower_len, bumps=[], horizontal=False, reverse_direction=False, axis_offset=0, axis=True, bump_height=3, slow_rise=False):
+    def add_cam(self, xpos, ypos, follower_len, bumps=[], horizontal=False, reverse_direction=False, axis_offset=0, axis=True, bump_height=3, slow_rise=False, name=None):
         """ Very basic function which just adds a motorised circle with a bump.
         phase is between 0 and 1 and adjusts initial rotation.
         horizontal/vertical: Vertical means the output moves in a vertical direction, which means the follower is on top of the cam.
         reverse_direction puts the cam on the other side and only makes sense for horizontal cams.
+        name is the cam's signal name, used in diagnostics.
         """
         attachment_body = self.groundBody
         offset = 0
@@ -719,8 +869,8 @@ class Memory (Framework):
             offset = -0.25
         if reverse_direction:
             offset = 0.5
-        for b in range(0,len(bumps)):
-            bumps[b] = (bumps[b][0] + offset, bumps[b][1])
+        # Make a new list; 'bumps' is often shared with the cams table
+        bumps = [(start + offset, length) for (start, length) in bumps]
         radius = 30
         bump_height = radius+bump_height
         disc_fixture = fixtureDef(shape=circleShape(radius=radius, pos=(0,0)),density=1.0,filter=filters[0])
@@ -778,9 +928,14 @@ class Memory (Framework):
             else:
                 follower_body.attachment_point=(axle_x+follower_len, axle_y)
             self.revolving_joint(attachment_body, follower_body, (axle_x+2.5,axle_y+2.5), friction=False)
+            if slow_rise:
+                self.cam_followers.append(CamFollower(name, cam_body, follower_wheel, radius, [(bumps[0][0], 0.22)], height-radius))
+            else:
+                self.cam_followers.append(CamFollower(name, cam_body, follower_wheel, radius, bumps, bump_height-radius))
             print("Creating cam: xpos= {}, ypos= {}, axle_x = {} ,axle_y= {}, follower_len={}".format(xpos, ypos, axle_x, axle_y, follower_len))
 
         self.all_cam_drives.append(cam_driver)
+        self.cam_names.append(name)
         if axis:
             return follower_body
         else:
@@ -837,16 +992,35 @@ class Memory (Framework):
         self.instruction_inputs.reverse()
         self.instruction_outputs.reverse()
 
-    def ball_bearing_block(self, xpos, ypos,cols):
+    def ball_bearing_block(self, xpos, ypos,cols, name):
         for r in range(0,5):
             for col in range(0,cols):
                 test_data = self.add_ball_bearing(xpos+7*col+r%2,ypos+7*r,0)
+        # Bearings settle anywhere in the hopper around the block
+        self.regions.append(Region(name, xpos-40, ypos-40, xpos+7*cols+40, ypos+7*5+40, True))
         
     def set_initial_memory(self, memory_array):
         for x in range(0,8):
             for y in range(0,8):
                 if (memory_array[y] & 1<<x):
-                    self.add_ball_bearing(memory_col0_x + pitch*(7-x)+2, memory_row0_y + 14*y+41, 0)
+                    self.add_memory_bearing(memory_col0_x + pitch*(7-x)+2, memory_row0_y + 14*y+41)
+
+    def add_memory_bearing(self, xpos, ypos):
+        """ Adds a bearing to memory, reusing a parked one if there is one. """
+        if self.spare_bearings:
+            i = self.spare_bearings.pop()
+            self.ball_bearings[i][0].active = True
+            self.move_ball_bearing(i, (xpos*self.scale, ypos*self.scale), 0)
+        else:
+            self.add_ball_bearing(xpos, ypos, 0)
+
+    def clear_memory(self):
+        """ Removes every bearing sitting in a memory cell and parks it
+        (inactive, outside the machine) for reuse by add_memory_bearing. """
+        for i in self.capture_state().memory_bearings():
+            self.move_ball_bearing(i, (bearing_park_x*self.scale, bearing_park_y*self.scale), 0)
+            self.ball_bearings[i][0].active = False
+            self.spare_bearings.append(i)
 
     def setup_ssem(self):
         """ Sets up all the parts of the SSEM except cams. """
@@ -856,7 +1030,7 @@ class Memory (Framework):
         self.memory_sender_y = -500
         self.groundBody = groundBody
         # Initial charge for main injector
-        self.ball_bearing_block(0,190,cols=16)
+        self.ball_bearing_block(0,190,cols=16, name="main injector hopper")
         self.add_static_polygon([ (0,20), (100,0), (100,5), (0,25)], -132, 220)
         self.add_static_polygon([ (0,0), (3,0), (3,20), (0,20)], -132, 240)
         self.injector_cranks = []
@@ -877,7 +1051,7 @@ class Memory (Framework):
         self.pc_injector_cranks = []    
         self.parts.pc_injector_raiser = self.injector(pc_injector_x,pc_injector_y, groundBody, injector_crank_array=self.pc_injector_cranks, columns=5)
         # Initial charge for PC injector
-        self.ball_bearing_block(250,-240,cols=8)
+        self.ball_bearing_block(250,-240,cols=8, name="PC injector hopper")
 
 
         sub_pos_x = -15
@@ -900,9 +1074,11 @@ class Memory (Framework):
         skip_lever.origin = (skip_lever_x,skip_lever_y)
 
         self.revolving_joint(groundBody, skip_lever, (skip_lever_x+150, skip_lever_y+2.5), friction=0)
+        # Stray bearings can come to rest against the post under the pivot; they don't get in the way
+        self.regions.append(Region("skip lever pivot", skip_lever_x+130, skip_lever_y-30, skip_lever_x+160, skip_lever_y, True))
         self.add_static_polygon(polygonShape(vertices=box_vertices(0, 0, 10,10)), skip_lever_x+270, skip_lever_y-15, filter=filters[2])
         self.parts.cmp_injector = self.horizontal_injector(skip_lever_x-48,skip_lever_y+257, groundBody)
-        self.ball_bearing_block(skip_lever_x-30,skip_lever_y+280,cols=1)
+        self.ball_bearing_block(skip_lever_x-30,skip_lever_y+280,cols=1, name="CMP injector hopper")
         self.add_static_polygon(polygonShape(vertices=[(0,0), (20,0), (0,20)]), skip_lever_x-30,skip_lever_y+230)
                             
         self.lower_regenerators = []
@@ -920,7 +1096,7 @@ class Memory (Framework):
         self.add_static_polygon([ (0, 0), (5,0), (5,20), (0,20) ], pc_incrementer_x+27,-240+40)
 
 
-        self.ball_bearing_block(457+20,-250+30,cols=1)
+        self.ball_bearing_block(457+20,-250+30,cols=1, name="PC incrementer hopper")
         self.distance_joint(skip_lever, pc_incrementer)
 
         self.connect_regenerators()
@@ -929,6 +1105,7 @@ class Memory (Framework):
         self.add_static_polygon([ (-300,-600),(700,-550), (700,-610), (-300,-610)])
         self.add_static_polygon([ (600,-610),(700,-610), (850,-400), (800,-400)])
         self.add_static_polygon([ (-500,-400),(-450,-400), (-310,-610), (-400,-610)])
+        self.regions.append(Region("collection plates", -400, -620, 800, -540, True))
 
         # Instruction decoder ROM
         self.rom_followers = []
@@ -945,11 +1122,34 @@ class Memory (Framework):
 
         # Add one final transfer band to move everything back into band 0
         self.transfer_bands.append((-550+10, -550, [ (-300,800)], 1))
-
-    def basic_cam(self, x, y, arm_length, bumps, axis_offset=0, attachment_part=None, horizontal=False, reverse_direction=False, bump_height=3, slow_rise=False):
+        self.add_sensor_regions()
+
+    def add_sensor_regions(self):
+        """ Turns the transfer bands and the fake ball lift into sensor
+        fixtures on one static body. Box2D then tells us (via
+        BeginContact/EndContact) which bearings are near a region, so
+        Step only has to look at those. """
+        regions = []
+        for (top, bottom, xbands, source_plane) in self.transfer_bands:
+            for (left, right) in xbands:
+                regions.append(SensorRegion(top, bottom, left, right, source_plane))
+        # The lift needs one fixture per plane, since bearings in plane 1 only collide with group 2
+        lift_left = -5000
+        lift_right = 5000
+        lift_bottom = lift_y-1000
+        regions.append(SensorRegion(lift_y, lift_bottom, lift_left, lift_right, None))
+        sensor_fixtures = []
+        for r in regions:
+            shape = polygonShape(vertices=[(x*self.scale, y*self.scale) for (x,y) in box_vertices(r.left, r.bottom, r.right-r.left, r.top-r.bottom)])
+            planes = [0,1] if r.source_plane is None else [r.source_plane]
+            for plane in planes:
+                sensor_fixtures.append(fixtureDef(shape=shape, isSensor=True, filter=filters[plane], userData=r))
+        self.sensor_body = self.world.CreateStaticBody(fixtures=sensor_fixtures)
+
+    def basic_cam(self, x, y, arm_length, bumps, axis_offset=0, attachment_part=None, horizontal=False, reverse_direction=False, bump_height=3, slow_rise=False, name=None):
         follower_body = self.add_cam(x,y,arm_length, bumps=bumps, axis_offset=axis_offset,
                                      horizontal=horizontal, reverse_direction=reverse_direction,
-                                     bump_height=bump_height, slow_rise=slow_rise, axis=(attachment_part is not None))
+                                     bump_height=bump_height, slow_rise=slow_rise, axis=(attachment_part is not None), name=name)
         if attachment_part is not None: self.distance_joint(follower_body, attachment_part)
 
     def rake_cam(self, xpos, ypos):
@@ -960,6 +1160,7 @@ class Memory (Framework):
         cam_body = self.add_multifixture([disc_fixture], xpos, ypos)
         cam_driver = self.revolving_joint(attachment_body, cam_body, (xpos,ypos), motor=1, force=50)
         cam_driver.motorSpeed = 0.5
+        self.rake_drive = cam_driver
 
         crank_fixture = fixtureDef(shape=polygonShape(vertices=box_vertices(0,0,50,3)),density=1.0,filter=filters[2])
         crank_body = self.add_multifixture([crank_fixture], xpos+radius, ypos)
@@ -971,6 +1172,8 @@ class Memory (Framework):
         slider_body = self.add_multifixture([slider_fixture,pusher_fixture], xpos+radius+50, ypos)
         self.revolving_joint(crank_body, slider_body, (xpos+radius+50,ypos))
         self.slide_joint(attachment_body, slider_body, (1,0), -60, 60, friction=0)
+        # The rake never stops, so it's left out when deciding whether the machine has settled
+        self.rake_bodies = [cam_body, crank_body, slider_body]
 
     def slow_drop_unit(self, attachment_body, xpos, ypos):
         dropper_fixtures = []
@@ -1025,7 +1228,7 @@ class Memory (Framework):
         for c in cams:
             if c.signal_name in cam_mapping:
                 (attachment_part, arm_length) = cam_mapping[c.signal_name]
-                self.basic_cam(c.xpos, c.ypos, arm_length, c.steps, c.offset, attachment_part, horizontal=c.horizontal, bump_height=c.bump_height, reverse_direction=c.reverse_direction)
+                self.basic_cam(c.xpos, c.ypos, arm_length, c.steps, c.offset, attachment_part, horizontal=c.horizontal, bump_height=c.bump_height, reverse_direction=c.reverse_direction, name=c.signal_name)
             else:
                 raise Exception("Can't find a part to attach signal '{}' to ".format(c.signal_name))
 
@@ -1038,25 +1241,112 @@ class Memory (Framework):
         self.distance_joint(self.parts.cmp_injector, self.instruction_outputs[CMP])
 
         # Cam 20: Slow dropper
-        self.basic_cam(-300,-100, 80, [(0.65,0)], 8, self.dropper, horizontal=True, reverse_direction=True, bump_height=5, slow_rise=True)
+        self.basic_cam(-300,-100, 80, [(0.65,0)], 8, self.dropper, horizontal=True, reverse_direction=True, bump_height=5, slow_rise=True, name="SLOW DROPPER")
 
         # Notable timing points:
         # 0.31: Memory at PC has been read and regenerated
 
-    def __init__(self, testmode, randomtest, test_set_no, headless, overlay=False, timelapse=0):
-        super(Memory, self).__init__()
+    def __init__(self, testmode, randomtest, test_set_no, headless, overlay=False, timelapse=0, use_snapshot=False, build_only=False, kinematic_cams=False, time_scale=1.0):
+        """ build_only: Only build (and, with use_snapshot, settle) the
+        machine. select_test must then be called before running it.
+        kinematic_cams: Turn the cams at a fixed rate instead of driving
+        them with motors; see make_cams_kinematic.
+        time_scale: Run the machine this many times faster, in fewer
+        ticks; see compress_time. """
+        super(SSEM, self).__init__()
         self.labels = []
         self.stopFlag = False
         self.timelapse = timelapse
         self.settings.drawOverlay = overlay
-        self.test_set_no = test_set_no
         self.instruction_tested = False
         self.parts = Parts()
-        self.prewritten_test = False
-        self.random_test = False
         self.cycles_complete = 0
         self.phasetext = "Initializing"
-        settle_delay = 400
+        self.result = None
+
+        self.accumulator_toggles = []
+        self.ip_toggles = []
+        self.cams_on = False
+        self.all_cam_drives = []
+        self.cam_names = [] # Signal name of each of all_cam_drives
+        self.cam_followers = [] # CamFollower for each cam with a follower arm
+        self.regions = [] # Named parts of the machine, other than memory; see Region
+        self.all_toggle_drives = []
+        self.scale = 1.0
+        self.transfer_bands = []
+        self.ball_bearings = []
+        self.spare_bearings = [] # Indices of parked bearings; see clear_memory
+        self.sensor_contacts = set() # (bearing index, SensorRegion) pairs currently touching
+        self.static_polygons = []
+        self.dynamic_bodies = []
+        self.distance_links = []
+        self.sequence = 0 # Like step count but only increments when cams are on
+        self.init_pulse = 0 # A small counter for use at startup to reset the toggles
+        self.cam_base_angle = 0 # Cam angle at sequence 0; advances between session tests
+        self.session = None # Tests still to run in session mode
+        self.use_options(RunOptions())
+        self.phase_settings = {} # PhaseSettings for each SolverPhase
+        self.machine_state = None
+        self.settle_bodies = None # See find_settle_bodies
+        self.time_scale = time_scale
+        self.cycle_ticks = self.scaled_ticks(cycle_ticks)
+
+        self.setup_ssem()
+        self.setup_cams()
+
+        # Additional parts:
+        self.rake_cam(-80,190)
+
+        if time_scale != 1:
+            self.compress_time()
+        self.kinematic_cams = kinematic_cams
+        self.cam_speed = 0 # Angular velocity of the cams, in kinematic mode
+        if kinematic_cams:
+            self.make_cams_kinematic()
+
+        if use_snapshot:
+            self.settle_from_snapshot()
+
+        if not build_only:
+            self.select_test(testmode, randomtest, test_set_no)
+
+    def use_options(self, options):
+        """ Applies a RunOptions to this machine. """
+        self.cross_checking = options.cross_check
+        self.jam_detection = options.jam_detection
+        self.ledger_points = options.ledger_points
+        self.ledger_abort = options.ledger_abort
+        self.start_jitter = options.start_jitter
+        self.early_end = options.early_end
+        self.early_end_check = options.early_end_check
+        self.early_end_window = options.early_end_window
+        self.solver_scheduling = options.solver_scheduling
+
+    def reset_test(self):
+        self.prewritten_test = False
+        self.random_test = False
+        self.instruction_tested = False
+        self.result = None
+        self.unsupported = False
+        self.final_readout = None
+        self.failed_phase = None
+        self.early_failure = None
+        self.jam = None
+        self.bearing_ledger = None
+        self.early_verdict = None # (sequence, result) from check_early_end
+        self.early_end_agrees = None
+        self.last_readout = None
+        self.readout_since = 0
+        self.solver_iterations = 0 # Velocity and position iterations while the cams turn
+        self.test_start_tick = self.stepCount
+        self.test_start_time = time.time()
+        self.test_start_cpu = time.process_time()
+
+    def select_test(self, testmode, randomtest, test_set_no):
+        """ Chooses the test to run, works out its expected result with the
+        emulator and loads its initial state into the machine. """
+        self.reset_test()
+        self.test_set_no = test_set_no
         if randomtest:
             # Start a random test with test set 0 as the base
             self.test_set = test_set[0]
@@ -1065,16 +1355,15 @@ class Memory (Framework):
             randomseed = test_set_no
             if randomseed > 0:
                 random.seed(randomseed)
-            self.start_point = random.randint(settle_delay,settle_delay+100)
+            self.schedule_start()
             self.name="SSEM - Random test mode"
-            self.test_set['cycles'] = 3
+            self.test_set = dict(self.test_set, cycles=3)
         elif testmode:
             # Start a prewritten test
             self.auto_test_mode = True
             self.prewritten_test = True
             print("Running test {}".format(test_set_no))
-            self.start_point = random.randint(settle_delay,settle_delay+100)
-            print("Running test {} starting at tick {}".format(testmode, self.start_point))
+            self.schedule_start()
             self.test_set = test_set[self.test_set_no]
             self.name="SSEM - {}".format(self.test_set.get("name", "Automated test"))
         else:
@@ -1084,32 +1373,11 @@ class Memory (Framework):
             self.start_point = 0
             self.test_set = test_set[self.test_set_no]
 
-        self.accumulator_toggles = []
-        self.ip_toggles = []
-        self.cams_on = False
-        self.all_cam_drives = []
-        self.all_toggle_drives = []
-        self.scale = 1.0
-        self.transfer_bands = []
-        self.ball_bearings = []
-        self.static_polygons = []
-        self.dynamic_bodies = []
-        self.distance_links = []
-        self.sequence = 0 # Like step count but only increments when cams are on
-        self.init_pulse = 0 # A small counter for use at startup to reset the toggles
-
-        self.setup_ssem()
-        self.setup_cams()
-
-        # Additional parts:
-        self.rake_cam(-80,190)
-
-        
         self.initial_state = SSEM_State()
         if self.random_test:
             while True:
                 self.initial_state.set_random()
-                self.final_state = copy.deepcopy(self.initial_state)
+                self.final_state = self.initial_state.clone()
                 for i in range(0,self.test_set.get("cycles",1)):
                     self.final_state.advance()
                 if self.final_state.unsupported_flag:
@@ -1119,75 +1387,156 @@ class Memory (Framework):
         else:
             self.initial_state.accumulator = self.test_set.get("initial_accumulator", 0)
             self.initial_state.pc = self.test_set.get("initial_pc", 0)
-            self.initial_state.mem = self.test_set.get("initial_memory")
-            self.final_state = copy.copy(self.initial_state)
+            self.initial_state.mem = list(self.test_set.get("initial_memory"))
+            self.final_state = self.initial_state.clone()
             for i in range(0,self.test_set.get("cycles",1)):
                 self.final_state.advance()
             if self.final_state.unsupported_flag:
-                print("Exiting because unsupported operations were performed in the emulator.")
-                sys.exit(0)
-
+                self.stop_unsupported()
+                return
+        self.load_state()
+
+    def select_state(self, initial_state, cycles=1):
+        """ Like select_test, but runs 'cycles' instructions from an arbitrary SSEM_State. """
+        self.reset_test()
+        self.test_set_no = 0
+        self.test_set = { "cycles": cycles }
+        self.auto_test_mode = True
+        self.name = "SSEM - State test"
+        self.schedule_start()
+        self.initial_state = initial_state.clone()
+        self.final_state = initial_state.clone()
+        for i in range(0,cycles):
+            self.final_state.advance()
+        if self.final_state.unsupported_flag:
+            self.stop_unsupported()
+            return
+        self.load_state()
+
+    def schedule_start(self):
+        """ Sets an automated test to start the cams once the machine has
+        settled (see wait_for_settle), plus a random delay of up to
+        start_jitter_ticks if start_jitter is set. """
+        # Drawn whether or not it's used, so each random test seed still gives the same test
+        self.jitter = random.randint(0, start_jitter_ticks)
+        self.start_point = None # Not known until the machine settles
+        self.settled_ticks = 0
+
+    def settle_motion(self):
+        """ Returns the fastest linear speed (in units per second) and
+        angular speed of anything in the machine which ought to be at rest:
+        every awake dynamic body except the rake, which never stops, and
+        bearings resting in memory or a hopper, which the rake stirs. """
+        state = self.capture_state()
+        moving = ~state.resting_bearings()
+        speeds = np.hypot(state.bearing_velocity[moving,0], state.bearing_velocity[moving,1]).tolist()
+        spins = [0]
+        if self.settle_bodies is None:
+            self.settle_bodies = self.find_settle_bodies()
+        for (b, check_spin) in self.settle_bodies:
+            if b.type != b2_dynamicBody or not b.awake:
+                continue
+            speeds.append(b.linearVelocity.length/self.scale)
+            if check_spin:
+                spins.append(abs(b.angularVelocity))
+        return (max(speeds, default=0), max(spins))
+
+    def find_settle_bodies(self):
+        """ Returns (body, check_spin) for each body settle_motion watches,
+        other than the bearings. Comparing Box2D bodies is slow, so this is
+        done once rather than on every tick. """
+        # Follower wheels can keep spinning on their axles after the cams stop
+        wheels = [f.wheel for f in self.cam_followers]
+        found = []
+        for b in self.world.bodies:
+            if b.type != b2_dynamicBody or b in self.rake_bodies:
+                continue
+            if isinstance(b.fixtures[0].userData, int):
+                continue # A bearing, dealt with in settle_motion; they can roll in place
+            found.append((b, b not in wheels))
+        return found
+
+    def wait_for_settle(self):
+        """ Called each tick once the toggles have been reset. When the
+        machine has been at rest for settle_window ticks, or settle_limit
+        has passed, sets start_point. """
+        (speed, spin) = self.settle_motion()
+        still = speed < settle_speed*self.time_scale and spin < settle_spin*self.time_scale
+        self.settled_ticks = self.settled_ticks + 1 if still else 0
+        settled = self.settled_ticks >= self.scaled_ticks(settle_window)
+        if settled or self.init_pulse >= self.scaled_ticks(settle_limit):
+            self.start_point = self.init_pulse + (self.scaled_ticks(self.jitter) if self.start_jitter else 0)
+            print("Machine {} after {} ticks; starting cams at tick {}".format(
+                "settled" if settled else "still moving", self.init_pulse, self.start_point))
+
+    def stop_unsupported(self):
+        print("Stopping because unsupported operations were performed in the emulator.")
+        self.unsupported = True
+        self.result = UNSUPPORTED_OP
+        self.stopFlag = True
+
+    def load_state(self):
+        """ Loads self.initial_state into the machine and expects self.final_state at the end. """
         self.expected_state = self.final_state
+        # The emulator's state at the start of each cycle, for cross_check
+        self.expected_cycles = [self.initial_state.clone()]
+        for i in range(0, self.test_set.get("cycles",1)):
+            s = self.expected_cycles[-1].clone()
+            s.advance()
+            self.expected_cycles.append(s)
         self.set_initial_memory(self.initial_state.mem)
         self.initial_accumulator =  self.initial_state.accumulator
         self.initial_pc = self.initial_state.pc
         self.instruction_text="Fetching..."
+        # All bearings exist by now, so the state arrays can be allocated
+        self.machine_state = MachineState(self)
+        self.jam_detector = JamDetector(self)
+        self.bearing_ledger = BearingLedger(self)
+
+    def settle_from_snapshot(self):
+        """ Puts the machine into its settled state from the snapshot cache.
+        If there is no usable snapshot for this revision of the machine, it
+        is settled by running it for settle_delay ticks and the result is
+        cached. Must be called before any test-specific state is set up. """
+        variants = (["kinematic"] if self.kinematic_cams else []) + (["x{:g}".format(self.time_scale)] if self.time_scale != 1 else [])
+        variant = "-".join(variants) or None
+        data = world_snapshot.load_snapshot(variant)
+        if data is not None and world_snapshot.restore_world(self, data):
+            print("Restored settled world from snapshot")
+            return
+        delay = self.scaled_ticks(settle_delay)
+        print("No settled snapshot for this machine; settling for {} ticks".format(delay))
+        for i in range(0,delay):
+            self.world.Step(1.0/self.settings.hz, self.settings.velocityIterations, self.settings.positionIterations)
+            if self.sensor_contacts:
+                self.process_sensor_contacts()
+            self.drive_cams(0)
+        world_snapshot.save_snapshot(world_snapshot.capture_world(self), variant)
+
+    def capture_state(self):
+        """ Reads the whole machine into self.machine_state in one pass and returns it. """
+        return self.machine_state.capture()
 
     def read_pc_array(self):
-        return [1 if i.angle>0 else 0 for i in self.ip_toggles]
+        return self.capture_state().pc_bits().tolist()
 
     def read_accumulator_array(self):
-        return [0 if i.angle>0 else 1 for i in self.accumulator_toggles]
+        return self.capture_state().accumulator_bits().tolist()
         
     def read_pc_value(self):
-        bits = reversed(self.read_pc_array())
-        total = 0
-        val = 1
-        for b in bits:
-            total += b * val
-            val <<= 1
-        return total
+        return self.capture_state().pc_value()
     
     def read_accumulator_value(self):
-        bits = reversed(self.read_accumulator_array())
-        total = 0
-        val = 1
-        for b in bits:
-            total += b * val
-            val <<= 1
-        return total
+        return self.capture_state().accumulator_value()
 
     def read_memory_array(self):
-        memory = []
-        for row in range(0,8):
-            row_val = 0
-            for col in range(0,8):
-                for i in range(0,len(self.ball_bearings)):
-                    (b, plane) = self.ball_bearings[i]
-                    (x,y) = b.worldCenter
-                    x /= self.scale
-                    y /= self.scale
-                    
-                    expected_pos_x = memory_col0_x + pitch*(7-col)
-                    expected_pos_y = memory_row0_y + 14*row+40
-                    dx = expected_pos_x - x
-                    dy = expected_pos_y - y
-                    if abs(dx)<5 and abs(dy)<5:
-                        row_val += 1<<col
-            memory.append(row_val)
-        return memory
+        return self.capture_state().memory_array()
 
     def instruction_test(self):
         # Early test to see if instruction has been read correctly. If not, no point continuing with test.
-        columns = []
-        val = 0
-        for i in range(0,8):
-            (x,y) = self.memory_sensors[i].worldCenter
-            x /= self.scale
-            y /= self.scale
-            relative_pos = y - self.memory_sender_y
-            columns.append(1 if relative_pos > 2 else 0)
-            val += (1<<(7-i) if relative_pos>2 else 0)
+        state = self.capture_state()
+        columns = state.instruction_bits().tolist()
+        val = state.instruction_value()
         print("Instruction register value = {}".format(",".join(map(str,columns))))
         instruction_op = (val >> 5) & 0x7
         instruction_address = val & 0x1f
@@ -1195,13 +1544,36 @@ class Memory (Framework):
 
         self.instruction_tested = True
     
+    def read_out(self):
+        """ Reads the registers and memory back from the machine and keeps them in final_readout. """
+        state = self.capture_state()
+        self.final_readout = (state.accumulator_value(), state.pc_value(), state.memory_array())
+        return self.final_readout
+
+    def check_early_end(self):
+        """ Watches the accumulator, PC and memory towards the end of the
+        final cycle. Once early_end_point has passed and they've been
+        unchanged for early_end_window ticks, returns (sequence, result of
+        verify_results); otherwise None. """
+        final_cycle_start = (self.test_set.get("cycles",1)-1)*self.cycle_ticks
+        local_sequence = self.sequence - final_cycle_start
+        end_point = self.scaled_ticks(early_end_point)
+        window = self.scaled_ticks(self.early_end_window)
+        if local_sequence < end_point - window or self.sequence % max(1, self.scaled_ticks(early_end_interval)) != 0:
+            return None
+        readout = self.read_out()
+        if readout != self.last_readout:
+            self.last_readout = readout
+            self.readout_since = self.sequence
+        if local_sequence < end_point or self.sequence - self.readout_since < window:
+            return None
+        return (self.sequence, self.verify_results())
+
     def verify_results(self):
         expected_accumulator = self.test_set.get("expected_accumulator", self.initial_accumulator)
         expected_pc = self.test_set.get("expected_pc", 1)
         
-        accumulator = self.read_accumulator_value()
-        pc = self.read_pc_value()
-        memory = self.read_memory_array()
+        (accumulator, pc, memory) = self.read_out()
 
         if self.prewritten_test:
             if expected_accumulator != accumulator:
@@ -1237,95 +1609,310 @@ class Memory (Framework):
         print("PASS")
         return SUCCESS
 
+    def cross_check(self):
+        """ Compares the machine with the emulator at the check points in
+        each cycle. Returns an error code if they differ, otherwise None. """
+        cycle = self.sequence // self.cycle_ticks
+        local_sequence = self.sequence % self.cycle_ticks
+        if local_sequence == self.scaled_ticks(instruction_check_point):
+            before = self.expected_cycles[cycle]
+            expected = before.mem[before.pc]
+            instruction = self.capture_state().instruction_value()
+            # Address bits above the memory size are never decoded, so only compare the ones which are
+            (shift, address_mask) = instruction_format(memory_columns)
+            decoded = lambda i: (i >> shift, (i & address_mask) % memory_rows)
+            if decoded(instruction) != decoded(expected):
+                self.failed_phase = "fetch"
+                print("FAIL: In cycle {} fetch, emulated instruction {} but instruction register holds {}".format(cycle+1, expected, instruction))
+                return WRONG_INSTRUCTION
+        elif local_sequence == self.scaled_ticks(register_check_point):
+            after = self.expected_cycles[cycle+1]
+            state = self.capture_state()
+            accumulator = state.accumulator_value()
+            pc = state.pc_value() % memory_rows
+            if accumulator != after.accumulator:
+                self.failed_phase = "execute"
+                print("FAIL: In cycle {} execute, emulated accumulator {}, actual {}".format(cycle+1, after.accumulator, accumulator))
+                return WRONG_ACCUMULATOR
+            if pc != after.pc:
+                self.failed_phase = "PC increment"
+                print("FAIL: In cycle {} PC increment, emulated PC {}, actual {}".format(cycle+1, after.pc, pc))
+                return WRONG_IP
+        elif local_sequence == self.scaled_ticks(memory_check_point):
+            after = self.expected_cycles[cycle+1]
+            memory = self.capture_state().memory_array()
+            for a in range(0,memory_rows):
+                if after.mem[a] != memory[a]:
+                    self.failed_phase = "writeback"
+                    print("FAIL: In cycle {} writeback, at address {}, emulated memory {} but found {}".format(cycle+1, a, after.mem[a], memory[a]))
+                    return WRONG_MEMORY
+        return None
+
     def update_state(self):
-        local_sequence = self.sequence % 10000
-        if local_sequence < 1500:
+        simulation_time = (self.sequence % self.cycle_ticks)/self.cycle_ticks
+        if simulation_time < 0.15:
             self.phasetext = "Setup instruction address"
             self.instruction_text="Fetching..."
-        elif (local_sequence < 3600):
+        elif (simulation_time < 0.36):
             self.phasetext = "Instruction fetch"
-        elif (local_sequence < 4500):
+        elif (simulation_time < 0.45):
             self.phasetext = "Instruction decode"
-        elif (local_sequence < 8000):
+        elif (simulation_time < 0.8):
             self.phasetext = "Execute"
         else:
             self.phasetext = "Writeback"
     
-    def Step(self, settings):
-        super(Memory, self).Step(settings)
-        new_bearings = []
-        for i in range(0,len(self.ball_bearings)):
+    def sensor_contact_pair(self, contact):
+        """ Returns (bearing index, SensorRegion) if this contact is between a
+        bearing and a sensor region, otherwise None. """
+        dataA = contact.fixtureA.userData
+        dataB = contact.fixtureB.userData
+        if isinstance(dataB, SensorRegion):
+            (dataA, dataB) = (dataB, dataA)
+        if isinstance(dataA, SensorRegion) and isinstance(dataB, int):
+            return (dataB, dataA)
+        return None
+
+    def BeginContact(self, contact):
+        pair = self.sensor_contact_pair(contact)
+        if pair is not None:
+            self.sensor_contacts.add(pair)
+
+    def EndContact(self, contact):
+        pair = self.sensor_contact_pair(contact)
+        if pair is not None:
+            self.sensor_contacts.discard(pair)
+
+    def process_sensor_contacts(self):
+        """ Flips or lifts any bearing whose centre is inside a sensor region
+        it is touching. This can't be done inside the contact callbacks
+        because the world is locked during world.Step. """
+        pending = []
+        for (i, region) in self.sensor_contacts:
             (b, plane) = self.ball_bearings[i]
             (x,y) = b.worldCenter
             x /= self.scale
             y /= self.scale
-            for (top, bottom, xbands, source_plane) in self.transfer_bands:
-                if y<top and y>bottom and plane == source_plane:
-                    for (left, right) in xbands:
-                        if x>left and x<right:
-                            self.world.DestroyBody(b)
-                            plane = 1-source_plane
-                            #print("Flipping ball bearing from plane %d to plane %d"%(source_plane, plane))
-                            self.ball_bearings[i] = (self.world.CreateDynamicBody(
-                                position=b.worldCenter,
-                                fixtures=[fixtureDef(
-                                    shape=circleShape(radius=6.35/2*self.scale, pos=(0,0)),
-                                    density=5.0,
-                                    filter=filters[plane])],
-                                
-                                userData=(255,0,0) if plane==0 else (127,0,0)),plane)
-            # Fake ball lift - returns falling ball bearings to the top
-            if y<-650:
-                self.world.DestroyBody(b)
-                new_bearings.append((self.add_ball_bearing(-50, 250, 0), plane))
+            if region.source_plane is None:
+                if y<region.top:
+                    pending.append((i, None))
+            elif plane == region.source_plane and y<region.top and y>region.bottom and x>region.left and x<region.right:
+                pending.append((i, 1-region.source_plane))
+
+        handled = set()
+        for (i, new_plane) in pending:
+            if i in handled: continue
+            handled.add(i)
+            (b, plane) = self.ball_bearings[i]
+            if new_plane is None:
+                # Fake ball lift - returns falling ball bearings to the top
+                self.move_ball_bearing(i, (hopper_x*self.scale, hopper_y*self.scale), 0)
             else:
-                new_bearings.append((b, plane))
-        self.ball_bearings = new_bearings
+                #print("Flipping ball bearing from plane %d to plane %d"%(plane, new_plane))
+                self.move_ball_bearing(i, b.worldCenter, new_plane)
+
+    def move_ball_bearing(self, i, position, plane):
+        """ Moves bearing i to 'position' (world coordinates) at rest and puts it in
+        'plane'. The body and fixture are reused, so bearings are never
+        destroyed or created once the machine is built. """
+        (b, old_plane) = self.ball_bearings[i]
+        # Bearing bodies have their origin away from the circle, so
+        # place the body such that its centre ends up at 'position'.
+        centre = b.localCenter
+        b.transform = ((position[0]-centre[0], position[1]-centre[1]), 0)
+        b.linearVelocity = (0,0)
+        b.angularVelocity = 0
+        b.awake = True
+        if plane != old_plane:
+            b.fixtures[0].filterData = filters[plane]
+            b.userData = (255,0,0) if plane==0 else (127,0,0)
+            self.ball_bearings[i] = (b, plane)
 
-        if self.init_pulse < 25:
+    def Step(self, settings):
+        if self.solver_scheduling and self.cams_on:
+            phase = solver_phase((self.sequence % self.cycle_ticks)/self.cycle_ticks)
+            if phase not in self.phase_settings:
+                self.phase_settings[phase] = PhaseSettings(settings, phase)
+            settings = self.phase_settings[phase]
+        super(SSEM, self).Step(settings)
+        if self.cams_on:
+            self.solver_iterations += settings.velocityIterations + settings.positionIterations
+        if self.sensor_contacts:
+            self.process_sensor_contacts()
+
+        if self.init_pulse < self.scaled_ticks(25):
             bit = 0
             for d in self.accumulator_toggles:
-                d.motorSpeed = 10 if (self.initial_accumulator & 1<<(7-bit))==0 else -10
+                d.motorSpeed = (10 if (self.initial_accumulator & 1<<(7-bit))==0 else -10)*self.time_scale
                 bit += 1
             bit = 0
             for d in self.ip_toggles:
-                d.motorSpeed = -10 if (self.initial_pc & 1<<(4-bit))==0 else 10
+                d.motorSpeed = (-10 if (self.initial_pc & 1<<(4-bit))==0 else 10)*self.time_scale
                 bit += 1
-        elif self.init_pulse < 50:
+        elif self.init_pulse < self.scaled_ticks(50):
             for d in self.all_toggle_drives:
                 d.motorSpeed = 0
-        elif self.init_pulse == 100:
+        elif self.init_pulse == self.scaled_ticks(100):
             print("Initialization complete")
-        elif self.init_pulse == self.start_point:
+        if self.start_point is None and self.init_pulse >= self.scaled_ticks(50):
+            self.wait_for_settle()
+        # In interactive mode the cams wait for the user to start them
+        if self.auto_test_mode and self.init_pulse == self.start_point:
             self.cams_on = True
         self.init_pulse += 1
         
         if self.cams_on: self.sequence += 1
-        angleTarget = (self.sequence*math.pi*2/10000.0)
-        simulation_time = ((self.sequence%10000)/10000.0)
+        angleTarget = (self.sequence*math.pi*2/self.cycle_ticks)
+        simulation_time = ((self.sequence%self.cycle_ticks)/self.cycle_ticks)
         if self.sequence % 100 == 0 and self.cams_on:
             self.update_state()
+            state = self.capture_state()
             print("Step {} degrees timing = {} ACC= {} ({}) PC= {} ({}) Mem= {}".format(
-                self.sequence, simulation_time,"".join(map(str,self.read_accumulator_array())),
-                self.read_accumulator_value(), "".join(map(str,self.read_pc_array())), self.read_pc_value(),
-                format(",".join(map(str, self.read_memory_array())))))
+                self.sequence, simulation_time,"".join(map(str,state.accumulator_bits())),
+                state.accumulator_value(), "".join(map(str,state.pc_bits())), state.pc_value(),
+                format(",".join(map(str, state.memory_array())))))
         if simulation_time > 0.41 and not self.instruction_tested:
             self.instruction_test()
         if simulation_time > 0.9:
             self.instruction_tested = False
-        if angleTarget >= (math.pi*2*self.test_set.get("cycles",1)) and self.cams_on:
-            angleTarget -= math.pi*2
+        if self.cross_checking and self.cams_on and self.auto_test_mode and self.early_failure is None:
+            self.early_failure = self.cross_check()
+        if self.jam_detection and self.cams_on and self.auto_test_mode and self.early_failure is None \
+           and self.sequence % jam_check_interval == 0:
+            self.jam = self.jam_detector.check(angleTarget + self.cam_base_angle)
+            if self.jam:
+                print("JAMMED: {}".format(self.jam_description()))
+                self.early_failure = JAMMED
+        # Sessions need the cams to finish their turn before the next test
+        if self.early_end and self.session is None and self.cams_on and self.auto_test_mode \
+           and self.early_failure is None and self.early_verdict is None:
+            self.early_verdict = self.check_early_end()
+        if self.cams_on and self.auto_test_mode:
+            for leak in self.bearing_ledger.check(self.sequence):
+                print("LEAK at tick {}: {}".format(self.sequence, leak))
+                if self.ledger_abort and self.early_failure is None:
+                    self.early_failure = BEARINGS_LOST
+        if self.early_failure is not None and self.cams_on and (self.session is None or self.sequence % self.cycle_ticks == 0):
+            # Give up; the rest of the run can't pass. In a session, the cams
+            # finish their turn first so the next test starts from the same place.
             self.cams_on = False
-            print("Sequence complete; cams off")
+            print("Stopped after {} ticks; cams off".format(self.stepCount))
+            self.read_out()
+            self.finish_test(self.early_failure)
+        elif self.early_verdict is not None and not self.early_end_check and self.cams_on:
+            self.cams_on = False
+            print("Results settled after {} ticks; cams off".format(self.stepCount))
+            self.finish_test(self.early_verdict[1])
+        elif angleTarget >= (math.pi*2*self.test_set.get("cycles",1)) and self.cams_on:
+            self.cams_on = False
+            print("Sequence complete after {} ticks; cams off".format(self.stepCount))
             result = self.verify_results()
-            if result>0:
-                sys.exit(result)
-            if self.auto_test_mode:
-                self.stopFlag = True
-            
+            if self.early_verdict is not None:
+                (sequence, early_result) = self.early_verdict
+                self.early_end_agrees = (early_result == result)
+                if not self.early_end_agrees:
+                    print("WARNING: Ending at tick {} would have given {}, not {}".format(
+                        sequence, result_names.get(early_result, "ERROR"), result_names.get(result, "ERROR")))
+            self.finish_test(result)
+            if self.session is None:
+                angleTarget -= math.pi*2
+        if self.session is not None:
+            # end_session_test may just have moved the finished turns from
+            # sequence into cam_base_angle, so don't count them twice
+            angleTarget = self.sequence*math.pi*2/self.cycle_ticks
+        angleTarget += self.cam_base_angle
+
+        self.drive_cams(angleTarget)
+
+    def finish_test(self, result):
+        self.result = result
+        if self.session is not None:
+            self.end_session_test(result)
+        elif result>0 or self.auto_test_mode:
+            self.stopFlag = True
+
+    def start_session(self, tests, results_stream):
+        """ Runs 'tests' (test numbers, or seeds for random tests) in this same
+        world after the one already selected, writing a JSON line per test
+        to results_stream. """
+        self.session = list(tests)
+        self.session_results = results_stream
+        self.session_passed = True
+
+    def end_session_test(self, result):
+        record = result_record("random" if self.random_test else "test", self.test_set_no, self.run_result(),
+                               "kinematic" if self.kinematic_cams else "motor", self.time_scale,
+                               wall_time=time.time() - self.test_start_time,
+                               cpu_time=time.process_time() - self.test_start_cpu)
+        self.session_results.write(json.dumps(record)+"\n")
+        self.session_results.flush()
+        if result != SUCCESS:
+            self.session_passed = False
+        if not self.session:
+            self.stopFlag = True
+            return
+        # Rewind for the next test. The cams have done whole turns, so
+        # carry that angle over rather than turning them back.
+        self.cam_base_angle += self.sequence*math.pi*2/self.cycle_ticks
+        self.sequence = 0
+        self.init_pulse = 0
+        self.clear_memory()
+        self.select_test(self.prewritten_test, self.random_test, self.session.pop(0))
+
+    def make_cams_kinematic(self):
+        """ Makes every cam disc, and the rake, a kinematic body which
+        turns at a set angular velocity, instead of a dynamic body driven by
+        its joint's motor. The joints are kept so cam angles can still be
+        read, but with no dynamic body on either end the solver ignores
+        them, and drive_cams only has to do anything when the cams start
+        or stop. """
+        for d in self.all_cam_drives + [self.rake_drive]:
+            d.motorEnabled = False
+            d.bodyB.type = b2_kinematicBody
+        self.rake_drive.bodyB.angularVelocity = self.rake_drive.motorSpeed
+
+    def compress_time(self):
+        """ Makes everything in the machine happen time_scale times sooner,
+        along the same paths. Accelerations go up by time_scale squared, so
+        gravity and every motor's torque or force (including the joints
+        which use a stalled motor as friction) do too; speeds, spring
+        frequencies and damping go up by time_scale. The cams turn once
+        every cycle_ticks ticks. The step size is left alone, which at a
+        given hz is the same as stepping the original machine time_scale
+        times as far each tick. """
+        s = self.time_scale
+        self.world.gravity = self.world.gravity*(s*s)
+        for j in self.world.joints:
+            if isinstance(j, b2RevoluteJoint):
+                j.maxMotorTorque = j.GetMaxMotorTorque()*s*s
+                j.motorSpeed = j.motorSpeed*s
+            elif isinstance(j, b2PrismaticJoint):
+                j.maxMotorForce = j.maxMotorForce*s*s
+                j.motorSpeed = j.motorSpeed*s
+            elif isinstance(j, b2DistanceJoint):
+                j.frequency = j.frequency*s
+        for b in self.world.bodies:
+            b.linearDamping = b.linearDamping*s
+            b.angularDamping = b.angularDamping*s
+
+    def scaled_ticks(self, ticks):
+        """ The number of ticks which take as long at this machine's
+        time_scale as 'ticks' do at time_scale 1. """
+        return int(round(ticks / self.time_scale))
+
+    def drive_cams(self, angleTarget):
+        if self.kinematic_cams:
+            # Turning at this rate from when the cams start, they keep pace with angleTarget
+            speed = math.pi*2*self.settings.hz/self.cycle_ticks if self.cams_on else 0
+            if speed != self.cam_speed:
+                for d in self.all_cam_drives:
+                    d.bodyB.angularVelocity = speed
+                self.cam_speed = speed
+            return
         for d in self.all_cam_drives:
             angleError = d.angle - angleTarget
-            gain = 1.0
+            # Keeps the cams the same angle behind their target however fast they turn
+            gain = 1.0*self.time_scale
             d.motorSpeed = (-gain * angleError)
 
     def Keyboard(self, key):
@@ -1333,5 +1920,145 @@ class Memory (Framework):
         if key == Keys.K_r:
             self.cams_on = not self.cams_on
 
+    def jam_description(self):
+        if self.jam is None:
+            return None
+        (x, y) = self.jam.position
+        return "{} at ({:.0f}, {:.0f}) {}".format(self.jam.body, x, y, self.jam.message)
+
+    def solver_schedule_record(self):
+        """ The solver schedule in use as a list of SolverPhase lists, with
+        the quiet settings last, or None if the settings are fixed. """
+        if not self.solver_scheduling:
+            return None
+        return [list(phase) for phase in solver_schedule] + [list(quiet_solver)]
+
+    def run_result(self, build_time=0, run_time=0):
+        """ Returns a RunResult describing the test which has just run. """
+        (accumulator, pc, memory) = self.final_readout if self.final_readout else (None, None, None)
+        return RunResult(result=self.result,
+                         result_name=result_names.get(self.result, "ERROR"),
+                         unsupported=self.unsupported,
+                         accumulator=accumulator, pc=pc, memory=memory,
+                         initial_state=self.initial_state,
+                         cycles=self.test_set.get("cycles",1),
+                         failed_phase=self.failed_phase,
+                         jam=self.jam_description(),
+                         ledger=self.bearing_ledger.entries if self.bearing_ledger else None,
+                         leaks=self.bearing_ledger.violations if self.bearing_ledger else None,
+                         early_end=self.early_verdict[0] if self.early_verdict else None,
+                         early_end_agrees=self.early_end_agrees,
+                         solver_schedule=self.solver_schedule_record(),
+                         solver_iterations=self.solver_iterations,
+                         expected_state=self.expected_state if not self.unsupported else self.final_state,
+                         ticks=self.stepCount - self.test_start_tick,
+                         build_time=build_time, run_time=run_time)
+
+class Memory(SSEM, HeadlessFramework):
+    """ The SSEM without a GUI. """
+    pass
+
+def gui_memory_class():
+    """ Returns the SSEM class with the Pygame front end. Pygame is only
+    imported when this is called. """
+    from backends.modified_pygame_framework import ModifiedPygameFramework
+    class GuiMemory(SSEM, ModifiedPygameFramework):
+        pass
+    return GuiMemory
+
+def run_headless(select, use_snapshot=False, quiet=True, kinematic_cams=False, time_scale=1.0, **options):
+    """ Builds a headless machine, calls select(machine) to load a test, runs it and returns a RunResult.
+    kinematic_cams builds the machine with kinematic cams; see
+    make_cams_kinematic. time_scale runs the machine that many times
+    faster; see compress_time. Any other keyword arguments are RunOptions
+    fields: unless cross_check is False, the run stops at the first phase
+    where the machine differs from the emulator, unless jam_detection is
+    False it also stops if the machine jams, and so on. """
+    run_options = RunOptions(**options)
+    if kinematic_cams and run_options.solver_scheduling:
+        raise ValueError("The solver schedule can't be used with kinematic cams")
+    output = open(os.devnull, "w") if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        start = time.time()
+        machine = Memory(False, False, 0, True, use_snapshot=use_snapshot, build_only=True, kinematic_cams=kinematic_cams, time_scale=time_scale)
+        built = time.time()
+        machine.use_options(run_options)
+        select(machine)
+        machine.run()
+        end = time.time()
+    if quiet:
+        output.close()
+    return machine.run_result(build_time=built-start, run_time=end-built)
+
+def run_test(test_set_no, randomtest=False, use_snapshot=False, **options):
+    """ Runs prewritten test number 'test_set_no', or with randomtest, a
+    random test using that number as the seed. Other keyword arguments are
+    those of run_headless. Returns a RunResult. """
+    return run_headless(lambda m: m.select_test(not randomtest, randomtest, test_set_no), use_snapshot=use_snapshot, **options)
+
+def run_state(initial_state, cycles=1, use_snapshot=False, **options):
+    """ Runs 'cycles' instructions on the machine starting from the SSEM_State
+    'initial_state' and checks the result against the emulator. Other
+    keyword arguments are those of run_headless. Returns a RunResult. """
+    return run_headless(lambda m: m.select_state(initial_state, cycles), use_snapshot=use_snapshot, **options)
+
+def cli(argv=None):
+    """ The command line interface. Returns the process exit code. """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--test', action='store_true')
+    parser.add_argument('--randomtest', action='store_true')
+    parser.add_argument('--headless', action='store_true')
+    parser.add_argument('--overlay', action='store_true')
+    parser.add_argument('--timelapse', type=int, default=0)
+    parser.add_argument('--snapshot', action='store_true', help="Start from a cached settled world (created on first use)")
+    parser.add_argument('--session', type=int, nargs='+', help="Run these tests (or random seeds) one after another in one world")
+    parser.add_argument('--results', help="File to append session results to as JSON lines (default: stdout)")
+    parser.add_argument('--no-cross-check', action='store_true', help="Run every test to the end even once it differs from the emulator")
+    parser.add_argument('--no-jam-detection', action='store_true', help="Don't stop tests when the machine jams")
+    parser.add_argument('--ledger-points', type=int, nargs='+', default=bearing_ledger.default_points,
+                        help="Ticks into each cycle (0-9999) at which to count bearings in each region")
+    parser.add_argument('--ledger-abort', action='store_true', help="Stop tests as soon as the bearing ledger finds a bearing missing")
+    parser.add_argument('--start-jitter', action='store_true', help="Start the cams up to {} ticks after the machine settles, at random".format(start_jitter_ticks))
+    parser.add_argument('--no-early-end', action='store_true', help="Run every test until the cams finish their turn, even once the results have settled")
+    parser.add_argument('--check-early-end', action='store_true', help="Run to the end of the turn anyway and warn if ending early would have given a different verdict")
+    parser.add_argument('--early-end-window', type=int, default=early_end_window, help="Ticks the results must stay unchanged for before ending early")
+    parser.add_argument('--kinematic-cams', action='store_true', help="Turn the cams at a fixed rate instead of driving them with motors")
+    parser.add_argument('--solver-schedule', action='store_true', help="Change solver settings through each cycle as set out in cams.solver_schedule")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Run the machine this many times faster, with stronger gravity and motors and a shorter cycle")
+    parser.add_argument('--solver-profile', choices=sorted(solver_profiles), help="Use one of the named physics settings in settings.solver_profiles")
+    parser.add_argument('testset', type=int, default=0, nargs='?')
+    args = parser.parse_args(argv)
+    if args.time_scale <= 0:
+        parser.error("--time-scale must be greater than 0")
+    if args.kinematic_cams and args.solver_schedule:
+        parser.error("--solver-schedule can't be used with --kinematic-cams")
+    # Show the emulator's account of each instruction, as before
+    logging.basicConfig(level=logging.INFO)
+    if args.solver_profile:
+        fwSettings.use_profile(args.solver_profile)
+    machine_class = Memory if args.headless else gui_memory_class()
+    # A session starts with its first test
+    testset = args.session[0] if args.session else args.testset
+    machine = machine_class(args.test, args.randomtest, testset, args.headless, args.overlay, args.timelapse, args.snapshot,
+                            kinematic_cams=args.kinematic_cams, time_scale=args.time_scale)
+    machine.use_options(RunOptions(cross_check=not args.no_cross_check,
+                                   jam_detection=not args.no_jam_detection,
+                                   ledger_points=args.ledger_points,
+                                   ledger_abort=args.ledger_abort,
+                                   start_jitter=args.start_jitter,
+                                   early_end=not args.no_early_end,
+                                   early_end_check=args.check_early_end,
+                                   early_end_window=args.early_end_window,
+                                   solver_scheduling=args.solver_schedule))
+    if args.session:
+        results_stream = open(args.results, "a") if args.results else sys.stdout
+        machine.start_session(args.session[1:], results_stream)
+        main(machine)
+        return 0 if machine.session_passed else 1
+    main(machine)
+    if machine.result == UNSUPPORTED_OP:
+        return 0
+    return machine.result or 0
+
 if __name__=="__main__":
-    main(Memory(args.test, args.randomtest, args.testset, args.headless, args.overlay, args.timelapse))
+    sys.exit(cli())
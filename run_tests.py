@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+# Parallel test runner for the Box2D SSEM. This replaces test.sh and
+# randomtest.sh: it runs headless tests over a process pool, building a
+# new machine for each test with main.run_test, and writes one JSON
+# record per run to a results file named after the current git revision.
+
+import argparse
+import collections
+import contextlib
+import json
+import math
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+
+import test_corpus
+from main import SUCCESS, UNSUPPORTED_OP, result_record, run_test, run_state
+from test_sets import test_set
+from constants import instruction_opcodes
+from settings import fwSettings, solver_profiles
+
+
+# Random tests always run this many cycles; see Memory.__init__
+random_test_cycles = 3
+
+source_dir = os.path.dirname(os.path.abspath(__file__))
+
+def parse_range(text):
+    """ Parses '3', '1-20' or '0,2,5-7' into a list of integers. """
+    numbers = []
+    for part in text.split(","):
+        if "-" in part:
+            (first, last) = part.split("-")
+            numbers.extend(range(int(first), int(last)+1))
+        else:
+            numbers.append(int(part))
+    return numbers
+
+def job_cycles(kind, number, corpus=None):
+    """ The number of instructions a test executes. """
+    if kind == "test":
+        return test_set[number].get("cycles", 1)
+    elif kind == "corpus":
+        return int(corpus[number]["cycles"])
+    return random_test_cycles
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=source_dir, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def run_one(job):
+    """ Runs a single headless test in this process. 'job' is a tuple of
+    (kind, number, use_snapshot, corpus filename, cam drive, time scale,
+    solver scheduling) where kind is 'test', 'random' or 'corpus' and cam
+    drive is 'motor' or 'kinematic'. Returns a dictionary describing the run. """
+    (kind, number, use_snapshot, corpus_filename, cam_drive, time_scale, solver_scheduling) = job
+    kinematic_cams = (cam_drive == "kinematic")
+    # Pool workers are forked with the same random state, which would give every test the same start jitter
+    random.seed()
+    corpus = test_corpus.load_corpus(corpus_filename) if corpus_filename else None
+    cpu_before = cpu_seconds()
+    start = time.time()
+    if kind == "corpus":
+        record = corpus[number]
+        r = run_state(test_corpus.initial_state(record), int(record["cycles"]), use_snapshot=use_snapshot, kinematic_cams=kinematic_cams,
+                      time_scale=time_scale, solver_scheduling=solver_scheduling)
+    else:
+        r = run_test(number, randomtest=(kind == "random"), use_snapshot=use_snapshot, kinematic_cams=kinematic_cams,
+                     time_scale=time_scale, solver_scheduling=solver_scheduling)
+    return result_record(kind, number, r, cam_drive, time_scale,
+                         wall_time=time.time() - start, cpu_time=cpu_seconds() - cpu_before)
+
+def wilson_interval(passes, total, z):
+    """ The Wilson score interval for a pass rate. Returns (low, high). """
+    if total == 0:
+        return (0.0, 1.0)
+    p = passes / total
+    centre = (p + z*z/(2*total)) / (1 + z*z/total)
+    half_width = z * math.sqrt(p*(1-p)/total + z*z/(4*total*total)) / (1 + z*z/total)
+    return (max(0.0, centre - half_width), min(1.0, centre + half_width))
+
+class ReliabilityEstimate():
+    """ A running pass rate with confidence intervals, overall and for the
+    tests which executed each opcode.
+
+    The interval is recalculated after every test and the campaign stops
+    as soon as it is good enough, which makes the stated confidence
+    slightly optimistic; use a higher confidence if that matters. """
+    def __init__(self, confidence=0.95):
+        self.z = statistics.NormalDist().inv_cdf((1+confidence)/2)
+        self.passes = 0
+        self.total = 0
+        self.op_passes = {}
+        self.op_totals = {}
+
+    def add(self, passed, ops):
+        self.total += 1
+        self.passes += passed
+        for op in set(ops or []):
+            self.op_totals[op] = self.op_totals.get(op, 0) + 1
+            self.op_passes[op] = self.op_passes.get(op, 0) + passed
+
+    def interval(self):
+        return wilson_interval(self.passes, self.total, self.z)
+
+    def summary(self):
+        (low, high) = self.interval()
+        return "{}/{} passed, {:.1f}% ({:.1f}-{:.1f}%)".format(self.passes, self.total, 100.0*self.passes/self.total if self.total else 0.0, 100*low, 100*high)
+
+    def op_summaries(self):
+        lines = []
+        for op in instruction_opcodes:
+            if op in self.op_totals:
+                (passes, total) = (self.op_passes[op], self.op_totals[op])
+                (low, high) = wilson_interval(passes, total, self.z)
+                lines.append("{}: {}/{} passed, {:.1f}% ({:.1f}-{:.1f}%)".format(op, passes, total, 100.0*passes/total, 100*low, 100*high))
+        return lines
+
+    def regressed(self, threshold):
+        """ True if the pass rate is known to be below 'threshold'. """
+        return threshold is not None and self.interval()[1] < threshold
+
+    def stop_reason(self, precision, threshold, min_tests):
+        """ Why the campaign can stop now, or None. """
+        if self.total < min_tests:
+            return None
+        (low, high) = self.interval()
+        if self.regressed(threshold):
+            return "regression: pass rate is below {:.1f}%".format(100*threshold)
+        if (high - low) / 2 <= precision:
+            return "pass rate known to within {:.1f}%".format(100*precision)
+        return None
+
+def compare_cam_drives(results):
+    """ Prints the pass rate and speed of each cam drive mode, and any tests
+    which gave different results in different modes. """
+    drives = sorted(set(r["cam_drive"] for r in results))
+    for drive in drives:
+        runs = [r for r in results if r["cam_drive"] == drive and r["exit_code"] != UNSUPPORTED_OP]
+        passed = sum(1 for r in runs if r["exit_code"] == SUCCESS)
+        ticks = sum(r["ticks"] or 0 for r in runs)
+        cpu_time = sum(r["cpu_time"] for r in runs)
+        print("{}: {}/{} passed, {:.0f} ticks per CPU-second".format(drive, passed, len(runs), ticks / cpu_time if cpu_time else 0))
+    verdicts = {}
+    for r in results:
+        verdicts.setdefault((r["kind"], r["number"]), {})[r["cam_drive"]] = r["result"]
+    for ((kind, number), by_drive) in sorted(verdicts.items()):
+        if len(set(by_drive.values())) > 1:
+            print("  {} {}: {}".format(kind, number, ", ".join("{} {}".format(d, by_drive[d]) for d in sorted(by_drive))))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run headless SSEM tests in parallel.")
+    parser.add_argument('--tests', type=parse_range, default=[], help="Prewritten test numbers, e.g. 0-6")
+    parser.add_argument('--random', type=parse_range, default=[], help="Random test seeds, e.g. 1-20")
+    parser.add_argument('--corpus', help="Run tests from this corpus file (see test_corpus.py)")
+    parser.add_argument('--corpus-tests', type=parse_range, help="Which corpus records to run, e.g. 0-99 (default: all)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Number of tests to run at once")
+    parser.add_argument('--output', default="testresults", help="Directory for results files")
+    parser.add_argument('--snapshot', action='store_true', help="Start each test from the cached settled world")
+    parser.add_argument('--fork', action='store_true', help="Build the machine once and fork a child per test (implies --snapshot)")
+    parser.add_argument('--cam-drive', choices=["motor", "kinematic", "both"], default="motor",
+                        help="Drive the cams with motors, turn them kinematically, or run every test both ways and compare")
+    parser.add_argument('--solver-schedule', action='store_true', help="Change solver settings through each cycle as set out in cams.solver_schedule")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Run the machine this many times faster; see Memory.compress_time")
+    parser.add_argument('--solver-profile', choices=sorted(solver_profiles), help="Use one of the named physics settings in settings.solver_profiles")
+    parser.add_argument('--campaign', action='store_true', help="Run random tests (or corpus tests) until the pass rate is known well enough; see --precision and --threshold")
+    parser.add_argument('--precision', type=float, default=0.05, help="Campaign: stop when the pass rate is known to within this (default 0.05)")
+    parser.add_argument('--threshold', type=float, help="Campaign: stop as soon as the pass rate is confidently below this, e.g. 0.9")
+    parser.add_argument('--confidence', type=float, default=0.95, help="Campaign: confidence level of the intervals")
+    parser.add_argument('--max-tests', type=int, default=2000, help="Campaign: never run more than this many tests")
+    parser.add_argument('--min-tests', type=int, default=10, help="Campaign: always run at least this many tests")
+    args = parser.parse_args()
+    if args.time_scale <= 0:
+        parser.error("--time-scale must be greater than 0")
+    # Set before the pool is forked, so every worker inherits it
+    if args.solver_profile:
+        fwSettings.use_profile(args.solver_profile)
+
+    if args.solver_schedule and args.cam_drive != "motor":
+        parser.error("--solver-schedule can't be used with kinematic cams")
+    if args.fork and args.cam_drive == "both":
+        parser.error("--fork can't be used with --cam-drive both")
+    tests = args.tests
+    corpus_tests = []
+    if args.corpus:
+        corpus_tests = args.corpus_tests or range(0, len(test_corpus.load_corpus(args.corpus)))
+        if args.fork:
+            parser.error("--fork can't be used with --corpus")
+    elif args.campaign:
+        # Fresh random seeds; the campaign stops long before it runs out
+        if not args.random:
+            args.random = range(1, args.max_tests+1)
+    elif not tests and not args.random:
+        tests = range(0, len(test_set))
+    if args.campaign:
+        tests = []
+    drives = ["motor", "kinematic"] if args.cam_drive == "both" else [args.cam_drive]
+    options = (args.time_scale, args.solver_schedule)
+    jobs = ([("test", n, args.snapshot, None, d) + options for n in tests for d in drives]
+            + [("random", n, args.snapshot, None, d) + options for n in args.random for d in drives]
+            + [("corpus", n, args.snapshot, args.corpus, d) + options for n in corpus_tests for d in drives])
+
+    revision = git_revision()
+    os.makedirs(args.output, exist_ok=True)
+    results_filename = os.path.join(args.output, "{}.jsonl".format(revision))
+
+    results = []
+    estimate = ReliabilityEstimate(args.confidence)
+    stop_reason = None
+    regressed = False
+    with contextlib.ExitStack() as stack:
+        results_file = stack.enter_context(open(results_filename, "a"))
+        if args.fork:
+            import fork_server
+            machine = fork_server.build_machine(kinematic_cams=(args.cam_drive == "kinematic"), time_scale=args.time_scale,
+                                                solver_scheduling=args.solver_schedule)
+            # Closed on the way out, which kills any children still running if the campaign stops early
+            run_results = stack.enter_context(contextlib.closing(
+                fork_server.run_jobs([job[:2] for job in jobs], args.jobs, machine=machine)))
+        else:
+            pool = stack.enter_context(Pool(args.jobs))
+            run_results = pool.imap_unordered(run_one, jobs)
+        for r in run_results:
+            r["revision"] = revision
+            results.append(r)
+            results_file.write(json.dumps(r)+"\n")
+            results_file.flush()
+            drive = " [{}]".format(r["cam_drive"]) if args.cam_drive == "both" else ""
+            print("{} {}{} > {} ({:.1f}s, {} ticks)".format(r["kind"], r["number"], drive, r["result"], r["wall_time"], r["ticks"]))
+            if r["jam"]:
+                print("  Jammed: {}".format(r["jam"]))
+            if args.campaign and r["exit_code"] != UNSUPPORTED_OP:
+                estimate.add(r["exit_code"] == SUCCESS, r["ops"])
+                print("  {}".format(estimate.summary()))
+                stop_reason = estimate.stop_reason(args.precision, args.threshold, args.min_tests)
+                regressed = stop_reason is not None and estimate.regressed(args.threshold)
+                if stop_reason or len(results) >= args.max_tests:
+                    break
+        if args.campaign and not args.fork:
+            # Abandon the tests still running
+            pool.terminate()
+
+    # Tests using operations the machine can't do were never run; they neither pass nor fail
+    ran = [r for r in results if r["exit_code"] != UNSUPPORTED_OP]
+    passed = [r for r in ran if r["exit_code"] == SUCCESS]
+    cpu_hours = sum(r["cpu_time"] for r in results) / 3600.0
+    instructions = sum(r["cycles"] for r in passed)
+    print("Revision {}: {}/{} passed ({:.1f}%)".format(revision, len(passed), len(ran), 100.0*len(passed)/len(ran) if ran else 0.0))
+    if len(ran) < len(results):
+        print("Skipped {} tests which use unsupported operations".format(len(results) - len(ran)))
+    if cpu_hours > 0:
+        print("Throughput: {:.0f} instructions verified per CPU-hour".format(instructions / cpu_hours))
+    if instructions:
+        print("Solver iterations: {:.0f} per instruction verified".format(sum(r["solver_iterations"] or 0 for r in passed) / instructions))
+    phases = collections.Counter(r["failed_phase"] for r in results if r.get("failed_phase"))
+    if phases:
+        print("Stopped early at: {}".format(", ".join("{} {}".format(phase, n) for (phase, n) in phases.most_common())))
+    if args.cam_drive == "both":
+        compare_cam_drives(results)
+    print("Results written to {}".format(results_filename))
+    if args.campaign:
+        print("Campaign stopped: {}".format(stop_reason or "reached --max-tests"))
+        print("Pass rate {}".format(estimate.summary()))
+        for line in estimate.op_summaries():
+            print("  {}".format(line))
+        return 1 if regressed else 0
+    return 0 if len(passed) == len(ran) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Solver settings sweep for the Box2D SSEM.
+
+# The machine was tuned with pybox2d's testbed physics settings (60Hz, 8
+# velocity and 3 position iterations, warm starting and continuous
+# collision) and it isn't obvious how much of that it needs. This runs the
+# same random tests at every point of a grid of settings, records the pass
+# rate and the CPU time per instruction at each point, and prints the
+# points which no other point beats on both (the Pareto frontier). Pass
+# rates from a few tests are rough, so each comes with a confidence
+# interval, and the cheapest point whose interval overlaps the testbed
+# point's (or, if the testbed settings aren't in the grid, the most
+# reliable point's) is suggested as a named profile for
+# settings.solver_profiles. Overlapping only means the sweep couldn't
+# tell the two apart: run enough tests for the intervals to be narrow
+# before trusting the suggestion.
+#
+# Every cycle is 10000 ticks whatever the step rate, so changing hz
+# changes how fast the cams turn relative to gravity as well as the step
+# size.
+
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+from multiprocessing import Pool
+
+import run_tests
+from settings import fwSettings, solver_options, solver_profiles
+
+def parse_floats(text):
+    """ Parses '30,60' into a list of numbers. """
+    return [float(part) for part in text.split(",")]
+
+def parse_switches(text):
+    """ Parses '0', '1' or '0,1' into a list of booleans. """
+    return [part.strip() not in ("0", "off", "false") for part in text.split(",")]
+
+def use_options(options):
+    """ Pool initializer: applies a grid point's physics options in the worker. """
+    for (option, value) in options.items():
+        setattr(fwSettings, option, value)
+
+def run_point(options, seeds, jobs):
+    """ Runs the random tests 'seeds' with the given physics options.
+    Returns a dictionary describing the point. """
+    # The snapshot revision includes the physics options, so each point settles its own
+    test_jobs = [("random", seed, True, None, "motor", 1.0, False) for seed in seeds]
+    with Pool(jobs, initializer=use_options, initargs=(options,)) as pool:
+        results = list(pool.imap_unordered(run_tests.run_one, test_jobs))
+    passed = sorted(r["number"] for r in results if r["exit_code"] == 0)
+    cpu_time = sum(r["cpu_time"] for r in results)
+    # Failed tests usually stop early, so count the instructions actually run rather than those planned
+    instructions = sum(r["ticks"] or 0 for r in results) / 10000
+    return dict(options,
+                passed=len(passed),
+                total=len(results),
+                passed_seeds=passed,
+                cpu_time=cpu_time,
+                cpu_per_instruction=cpu_time / instructions if instructions else float("inf"))
+
+def pareto_frontier(points):
+    """ The points which no other point matches or beats on both pass count and cost. """
+    def dominates(q, p):
+        return (q["passed"] >= p["passed"] and q["cpu_per_instruction"] <= p["cpu_per_instruction"]
+                and (q["passed"] > p["passed"] or q["cpu_per_instruction"] < p["cpu_per_instruction"]))
+    return [p for p in points if not any(dominates(q, p) for q in points)]
+
+def interval(point, z):
+    """ The confidence interval for a point's pass rate. Returns (low, high). """
+    return run_tests.wilson_interval(point["passed"], point["total"], z)
+
+def choose_profile(points, z):
+    """ The cheapest point whose pass rate interval overlaps the reference
+    point's. The reference is the testbed settings if the grid includes
+    them, otherwise the point with the best pass rate. Returns (chosen, reference). """
+    testbed = solver_profiles["testbed"]
+    matching = [p for p in points if all(p[option] == testbed[option] for option in solver_options)]
+    if matching:
+        reference = matching[0]
+    else:
+        reference = max(points, key=lambda p: p["passed"] / p["total"])
+    (reference_low, reference_high) = interval(reference, z)
+    similar = [p for p in points if interval(p, z)[1] >= reference_low and interval(p, z)[0] <= reference_high]
+    return (min(similar, key=lambda p: p["cpu_per_instruction"]), reference)
+
+def describe(point):
+    return "{:5.0f} {:4d} {:4d} {:>4} {:>4}".format(point["hz"], point["velocityIterations"], point["positionIterations"],
+                                                 "on" if point["enableWarmStarting"] else "off",
+                                                 "on" if point["enableContinuous"] else "off")
+
+def main():
+    testbed = solver_profiles["testbed"]
+    parser = argparse.ArgumentParser(description="Map the SSEM's reliability against cost over a grid of solver settings.")
+    parser.add_argument('--hz', type=parse_floats, default=[testbed["hz"]], help="Step rates, e.g. 45,60")
+    parser.add_argument('--velocity-iterations', type=run_tests.parse_range, default=[4, 6, 8], help="e.g. 4-8")
+    parser.add_argument('--position-iterations', type=run_tests.parse_range, default=[2, 3], help="e.g. 1-3")
+    parser.add_argument('--warm-starting', type=parse_switches, default=[True], help="0, 1 or 0,1")
+    parser.add_argument('--continuous', type=parse_switches, default=[False, True], help="0, 1 or 0,1")
+    parser.add_argument('--random', type=run_tests.parse_range, default=list(range(1, 11)), help="Random test seeds run at every point (default 1-10)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Number of tests to run at once")
+    parser.add_argument('--output', help="Append one JSON record per point to this file")
+    parser.add_argument('--confidence', type=float, default=0.95, help="Confidence level of the pass rate intervals")
+    parser.add_argument('--profile-name', default="fast", help="Name to suggest for the chosen profile")
+    args = parser.parse_args()
+    if not 0 < args.confidence < 1:
+        parser.error("--confidence must be between 0 and 1")
+    z = statistics.NormalDist().inv_cdf((1+args.confidence)/2)
+
+    grid = list(itertools.product(args.hz, args.velocity_iterations, args.position_iterations,
+                                  args.warm_starting, args.continuous))
+    print("Sweeping {} points with {} random tests each".format(len(grid), len(args.random)))
+    points = []
+    for values in grid:
+        options = dict(zip(solver_options, values))
+        point = run_point(options, args.random, args.jobs)
+        points.append(point)
+        print("{}: {}/{} passed, {:.2f} CPU-seconds per instruction".format(describe(point), point["passed"], point["total"],
+                                                                            point["cpu_per_instruction"]))
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(json.dumps(point)+"\n")
+
+    frontier = pareto_frontier(points)
+    print()
+    print("   hz  vel  pos warm  toi  passed  {:.0f}% interval  CPU-s/instr".format(100*args.confidence))
+    for p in sorted(points, key=lambda p: p["cpu_per_instruction"]):
+        (low, high) = interval(p, z)
+        print("{}  {:3d}/{:<3d}  {:5.1%}-{:<6.1%}  {:8.2f} {}".format(describe(p), p["passed"], p["total"], low, high,
+                                                                   p["cpu_per_instruction"], "*" if p in frontier else ""))
+    print("* on the Pareto frontier")
+    (chosen, reference) = choose_profile(points, z)
+    print()
+    print("Cheapest settings not measurably less reliable than {}: {:.0f}Hz, {}/{} iterations, warm starting {}, continuous {}".format(
+        "the testbed settings" if all(reference[o] == testbed[o] for o in solver_options) else "the most reliable point",
+        chosen["hz"], chosen["velocityIterations"], chosen["positionIterations"],
+        "on" if chosen["enableWarmStarting"] else "off", "on" if chosen["enableContinuous"] else "off"))
+    (low, high) = interval(chosen, z)
+    if high - low > 0.2:
+        print("The {:.0f}% interval for its pass rate is {:.1%}-{:.1%}; run more tests (--random) before relying on it".format(
+            100*args.confidence, low, high))
+    print("To use it, add this to solver_profiles in settings.py:")
+    print("    {!r}: dict({}),".format(args.profile_name, ", ".join("{}={!r}".format(option, chosen[option]) for option in solver_options)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
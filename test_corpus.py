@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Test corpus generator for the Box2D SSEM.
+
+# Random tests in main.py are made by randomising the whole machine and
+# running the emulator, and starting again whenever the emulator hits an
+# operation the machine can't do. This instead chooses memory words only
+# as the program reaches them, so the instructions it executes are always
+# ones the machine supports: no SB2 or HLT, and CMP only ever points at a
+# word holding zero.
+#
+# A corpus is a .npy file of records holding the initial state and the
+# emulator's expected final state. It can be memory-mapped, so runners can
+# read individual tests from very large corpora without loading them.
+
+import argparse
+import random
+import sys
+
+import numpy as np
+
+from constants import *
+from emulator import SSEM_State, twos_comp, instruction_format
+from test_sets import test_set
+
+corpus_dtype = np.dtype([("cycles", np.int32),
+                         ("pc", np.int64), ("accumulator", np.int64), ("mem", np.int64, (memory_rows,)),
+                         ("expected_pc", np.int64), ("expected_accumulator", np.int64), ("expected_mem", np.int64, (memory_rows,))])
+
+supported_ops = [JMP, JRP, LDN, STO, SUB, CMP]
+
+class Conflict(Exception):
+    """ Raised when a word which has already been chosen would make the program unsupported. """
+    pass
+
+class ProgramBuilder():
+    """ Builds one test by running a program whose memory is filled in as
+    it is read. Rows which have not been read yet are None. """
+    def __init__(self, rng):
+        self.rng = rng
+        (self.shift, address_mask) = instruction_format(memory_columns)
+        self.address_limit = address_mask + 1
+        self.initial = [None] * memory_rows
+        self.written = {}
+
+    def chosen(self, row):
+        return row in self.written or self.initial[row] is not None
+
+    def read(self, row):
+        if row in self.written:
+            return self.written[row]
+        if self.initial[row] is None:
+            self.initial[row] = self.rng.randint(0,255)
+        return self.initial[row]
+
+    def choose_instruction(self, pc):
+        """ Picks a supported instruction for row 'pc'. For CMP, the operand
+        row must hold zero, or still be free so that it can be made zero. """
+        rng = self.rng
+        while True:
+            op = rng.choice(supported_ops)
+            address = rng.randrange(0, self.address_limit)
+            if op != CMP:
+                return (op << self.shift) | address
+            candidates = [a for a in range(0, self.address_limit) if a % memory_rows != pc
+                          and (not self.chosen(a % memory_rows) or self.read(a % memory_rows) == 0)]
+            if candidates:
+                address = rng.choice(candidates)
+                if not self.chosen(address % memory_rows):
+                    self.initial[address % memory_rows] = 0
+                return (op << self.shift) | address
+
+    def execute(self, pc, accumulator):
+        """ Runs one instruction, choosing it first if row 'pc' is free.
+        Follows SSEM_State.advance. Returns the new (pc, accumulator). """
+        if not self.chosen(pc):
+            self.initial[pc] = self.choose_instruction(pc)
+        instruction = self.read(pc)
+        op = (instruction >> self.shift) & 7
+        row = (instruction % self.address_limit) % memory_rows
+        if op not in supported_ops:
+            raise Conflict()
+        if op == CMP and self.read(row) != 0:
+            raise Conflict()
+        if op == JMP:
+            pc = self.read(row)
+        elif op == JRP:
+            pc = (pc + self.read(row)) % memory_rows
+        elif op == LDN:
+            accumulator = twos_comp(-self.read(row))
+        elif op == STO:
+            self.written[row] = accumulator & ((2<<memory_columns)-1)
+        elif op == SUB:
+            accumulator = twos_comp(accumulator - self.read(row))
+        elif op == CMP:
+            if (accumulator & 0x80) == 0x80:
+                pc += 1
+        return ((pc + 1) % memory_rows, accumulator)
+
+def generate_test(rng, cycles):
+    """ Returns an initial SSEM_State which runs 'cycles' supported
+    instructions, and the emulator's final state. 'conflicts' counts the
+    rare cases where a word read earlier as data is later reached as an
+    unsupported instruction, and the program has to be started again. """
+    conflicts = 0
+    while True:
+        builder = ProgramBuilder(rng)
+        pc = rng.randint(0,memory_rows-1)
+        accumulator = rng.randint(0,(1<<memory_columns)-1)
+        state = SSEM_State()
+        state.pc = pc
+        state.accumulator = accumulator
+        try:
+            for i in range(0, cycles):
+                (pc, accumulator) = builder.execute(pc, accumulator)
+        except Conflict:
+            conflicts += 1
+            continue
+        # Rows the program never reached can hold anything
+        state.mem = [rng.randint(0,255) if word is None else word for word in builder.initial]
+        final_state = state.clone()
+        for i in range(0, cycles):
+            final_state.advance()
+        if final_state.unsupported_flag or (final_state.pc, final_state.accumulator) != (pc, accumulator):
+            raise Exception("Corpus generator disagrees with the emulator for {}".format(state))
+        return (state, final_state, conflicts)
+
+def record_from_states(record, initial_state, final_state, cycles):
+    record["cycles"] = cycles
+    record["pc"] = initial_state.pc
+    record["accumulator"] = initial_state.accumulator
+    record["mem"] = initial_state.mem
+    record["expected_pc"] = final_state.pc
+    record["expected_accumulator"] = final_state.accumulator
+    record["expected_mem"] = final_state.mem
+
+def fill_corpus(corpus, cycles, seed=None):
+    """ Fills the array 'corpus' (with corpus_dtype) with tests of 'cycles'
+    instructions. Returns the number of times generation had to start a
+    test again. """
+    rng = random.Random(seed)
+    conflicts = 0
+    for i in range(0, len(corpus)):
+        (initial_state, final_state, retries) = generate_test(rng, cycles)
+        record_from_states(corpus[i], initial_state, final_state, cycles)
+        conflicts += retries
+    return conflicts
+
+def write_corpus(filename, count, cycles, seed=None):
+    """ Generates 'count' tests of 'cycles' instructions and writes them to
+    filename as a .npy file. Records are written straight into a
+    memory-mapped file, so the corpus never has to fit in memory. """
+    corpus = np.lib.format.open_memmap(filename, mode="w+", dtype=corpus_dtype, shape=(count,))
+    conflicts = fill_corpus(corpus, cycles, seed)
+    corpus.flush()
+    return conflicts
+
+def write_prewritten_corpus(filename):
+    """ Writes the tests in test_sets.py to a corpus file. """
+    corpus = np.lib.format.open_memmap(filename, mode="w+", dtype=corpus_dtype, shape=(len(test_set),))
+    for (i, t) in enumerate(test_set):
+        state = SSEM_State()
+        state.pc = t.get("initial_pc", 0)
+        state.accumulator = t.get("initial_accumulator", 0)
+        state.mem = t.get("initial_memory")
+        final_state = state.clone()
+        for c in range(0, t.get("cycles", 1)):
+            final_state.advance()
+        record_from_states(corpus[i], state, final_state, t.get("cycles", 1))
+    corpus.flush()
+
+def load_corpus(filename):
+    """ Opens a corpus read-only without loading it into memory. """
+    return np.load(filename, mmap_mode="r")
+
+def initial_state(record):
+    """ The SSEM_State a corpus record starts from. """
+    state = SSEM_State()
+    state.pc = int(record["pc"])
+    state.accumulator = int(record["accumulator"])
+    state.mem = record["mem"].tolist()
+    return state
+
+def expected_state(record):
+    """ The SSEM_State the emulator finished in for a corpus record. """
+    state = SSEM_State()
+    state.pc = int(record["expected_pc"])
+    state.accumulator = int(record["expected_accumulator"])
+    state.mem = record["expected_mem"].tolist()
+    return state
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a corpus of supported SSEM tests to a .npy file.")
+    parser.add_argument('output', help="Corpus file to write")
+    parser.add_argument('--count', type=int, default=1000, help="Number of tests")
+    parser.add_argument('--cycles', type=int, default=3, help="Instructions per test")
+    parser.add_argument('--seed', type=int, help="Random seed")
+    parser.add_argument('--prewritten', action='store_true', help="Write the tests from test_sets.py instead")
+    args = parser.parse_args()
+    if args.prewritten:
+        write_prewritten_corpus(args.output)
+        print("Wrote {} prewritten tests to {}".format(len(test_set), args.output))
+        return 0
+    conflicts = write_corpus(args.output, args.count, args.cycles, args.seed)
+    print("Wrote {} tests of {} cycles to {} ({} restarts)".format(args.count, args.cycles, args.output, conflicts))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
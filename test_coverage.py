@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Coverage-driven test selection for the Box2D SSEM.
+
+# Each mechanical test takes about 20 seconds per instruction, so it's
+# worth choosing tests carefully. This runs every test in a candidate pool
+# through the emulator and records which features of the machine each one
+# exercises (see instruction_features), then picks a small set of tests
+# which covers everything the pool covers, by greedy set cover. Features
+# which no chosen test reaches are reported as gaps.
+
+import argparse
+import sys
+
+import numpy as np
+
+from constants import *
+from emulator import instruction_format
+import test_corpus
+
+def bits(value, width):
+    """ The bits of 'value', least significant first. """
+    return [(value >> i) & 1 for i in range(0, width)]
+
+def longest_chain(a, b, width, subtract=True):
+    """ The longest run of bits a borrow (or carry, if not subtract)
+    ripples through when working out a-b (or a+b) in 'width' bits. """
+    chain = longest = 0
+    carry = 0
+    for (x, y) in zip(bits(a, width), bits(b, width)):
+        if subtract:
+            carry = ((1-x) & y) | ((1-(x ^ y)) & carry)
+        else:
+            carry = (x & y) | ((x ^ y) & carry)
+        chain = chain + 1 if carry else 0
+        longest = max(longest, chain)
+    return longest
+
+pc_width = 5 # The program counter subtractor has five bits; see Memory.ip_toggles
+
+def instruction_features(state):
+    """ The coverage features the next instruction 'state' would execute
+    exercises. The state is not changed. """
+    (shift, address_mask) = instruction_format(memory_columns)
+    mem = state.mem
+    instruction = mem[state.pc]
+    op = (instruction >> shift) & 7
+    row = (instruction & address_mask) % memory_rows
+    name = instruction_opcodes[op]
+    operand = mem[row]
+    accumulator = state.accumulator
+    features = [("op", name), ("operand row", name, row), ("pc", state.pc)]
+    features.append(("pc carry chain", longest_chain(state.pc, 1, pc_width, subtract=False)))
+    if op in (LDN, SUB, JMP, JRP, CMP):
+        features += [("operand bit", name, col, b) for (col, b) in enumerate(bits(operand, memory_columns))]
+    if op == LDN:
+        features.append(("LDN borrow chain", longest_chain(0, operand, memory_columns)))
+    elif op == SUB:
+        features += [("accumulator bit in", col, b) for (col, b) in enumerate(bits(accumulator, memory_columns))]
+        features.append(("SUB borrow chain", longest_chain(accumulator, operand, memory_columns)))
+    elif op == STO:
+        features += [("stored bit", col, b) for (col, b) in enumerate(bits(accumulator, memory_columns))]
+    elif op == JRP:
+        features.append(("JRP carry chain", longest_chain(state.pc, operand, pc_width, subtract=False)))
+    elif op == CMP:
+        features.append(("CMP", "skip" if (accumulator & 0x80) == 0x80 else "no skip"))
+    return features
+
+def all_features():
+    """ Every feature a test made of supported instructions could exercise. """
+    names = [instruction_opcodes[op] for op in test_corpus.supported_ops]
+    features = [("op", n) for n in names]
+    features += [("operand row", n, row) for n in names for row in range(0, memory_rows)]
+    features += [("pc", pc) for pc in range(0, memory_rows)]
+    # Incrementing the PC only carries as far as the PC values the memory size allows
+    features += [("pc carry chain", c) for c in set(longest_chain(pc, 1, pc_width, subtract=False) for pc in range(0, memory_rows))]
+    features += [("operand bit", n, col, b) for n in ("LDN", "SUB", "JMP", "JRP", "CMP")
+                 for col in range(0, memory_columns) for b in (0, 1)
+                 if not (n == "CMP" and b == 1)]
+    features += [("LDN borrow chain", c) for c in range(0, memory_columns+1)]
+    features += [("accumulator bit in", col, b) for col in range(0, memory_columns) for b in (0, 1)]
+    features += [("SUB borrow chain", c) for c in range(0, memory_columns+1)]
+    features += [("stored bit", col, b) for col in range(0, memory_columns) for b in (0, 1)]
+    features += [("JRP carry chain", c) for c in range(0, pc_width+1)]
+    features += [("CMP", "skip"), ("CMP", "no skip")]
+    return set(features)
+
+def record_features(record):
+    """ The set of features a corpus record exercises over all its cycles. """
+    state = test_corpus.initial_state(record)
+    features = set()
+    for i in range(0, int(record["cycles"])):
+        features.update(instruction_features(state))
+        state.advance()
+    return features
+
+def greedy_cover(feature_sets, costs, max_tests=None):
+    """ Chooses tests by repeatedly taking the one which covers the most
+    new features per unit cost, until nothing more can be covered or
+    max_tests are chosen. Returns the list of chosen indices and the set
+    of features they cover. """
+    covered = set()
+    chosen = []
+    remaining = set(range(0, len(feature_sets)))
+    while remaining and (max_tests is None or len(chosen) < max_tests):
+        best = max(remaining, key=lambda i: (len(feature_sets[i] - covered) / costs[i], -i))
+        if not feature_sets[best] - covered:
+            break
+        chosen.append(best)
+        covered |= feature_sets[best]
+        remaining.discard(best)
+    return (chosen, covered)
+
+def main():
+    parser = argparse.ArgumentParser(description="Choose a small set of tests covering as much of the machine as possible.")
+    parser.add_argument('--corpus', help="Candidate pool (see test_corpus.py)")
+    parser.add_argument('--generate', type=int, default=5000, help="Without --corpus, generate this many candidates")
+    parser.add_argument('--cycles', type=int, default=3, help="Cycles for generated candidates")
+    parser.add_argument('--seed', type=int, help="Random seed for generated candidates")
+    parser.add_argument('--max-tests', type=int, help="Choose at most this many tests")
+    parser.add_argument('--output', help="Write the chosen tests to this corpus file, for run_tests.py --corpus")
+    args = parser.parse_args()
+
+    if args.corpus:
+        pool = test_corpus.load_corpus(args.corpus)
+    else:
+        pool = np.zeros(args.generate, dtype=test_corpus.corpus_dtype)
+        test_corpus.fill_corpus(pool, args.cycles, args.seed)
+    feature_sets = [record_features(record) for record in pool]
+    # Mechanical run time is roughly proportional to the number of cycles
+    costs = [int(record["cycles"]) for record in pool]
+    (chosen, covered) = greedy_cover(feature_sets, costs, args.max_tests)
+
+    universe = all_features()
+    pool_covered = set().union(*feature_sets)
+    print("{} candidates cover {}/{} features".format(len(pool), len(pool_covered & universe), len(universe)))
+    print("{} tests ({} cycles) chosen, covering {}/{} features".format(len(chosen), sum(costs[i] for i in chosen),
+                                                                        len(covered & universe), len(universe)))
+    gaps = sorted(universe - covered, key=str)
+    if gaps:
+        print("Not covered:")
+        for feature in gaps:
+            print("  {}".format(" ".join(map(str, feature))))
+    if args.output:
+        np.save(args.output, pool[sorted(chosen)])
+        print("Chosen tests written to {}".format(args.output))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
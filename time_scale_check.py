@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Time compression check for the Box2D SSEM.
+
+# With a time_scale above 1 the machine runs faster, in fewer ticks per
+# cycle (see Memory.compress_time), until something can no longer keep
+# up: Box2D caps how far a body can move in a step and its contact
+# thresholds are fixed, so past some point bearings miss their channels.
+# This runs the prewritten tests at a rising series of time scales and
+# reports the largest one at which they all still pass.
+
+import argparse
+import os
+import sys
+from multiprocessing import Pool
+
+import run_tests
+from main import SUCCESS, UNSUPPORTED_OP, cycle_ticks
+from solver_sweep import parse_floats
+from test_sets import test_set
+
+def run_scale(time_scale, tests, jobs):
+    """ Runs the prewritten tests 'tests' at time_scale. Returns the list of run records. """
+    test_jobs = [("test", n, True, None, "motor", time_scale, False) for n in tests]
+    with Pool(jobs) as pool:
+        return list(pool.imap_unordered(run_tests.run_one, test_jobs))
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the largest time scale at which the SSEM's prewritten tests pass.")
+    parser.add_argument('--scales', type=parse_floats, default=[1, 1.1, 1.2, 1.25, 1.5, 1.75, 2, 2.5, 3], help="Time scales to try, in order (default 1,1.1,1.2,1.25,1.5,1.75,2,2.5,3)")
+    parser.add_argument('--tests', type=run_tests.parse_range, default=list(range(0, len(test_set))), help="Prewritten test numbers (default: all)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Number of tests to run at once")
+    parser.add_argument('--keep-going', action='store_true', help="Try every scale, rather than stopping at the first which fails")
+    args = parser.parse_args()
+    if min(args.scales) <= 0:
+        parser.error("time scales must be greater than 0")
+
+    largest = None
+    passing = True # Every scale so far has passed
+    baseline_cpu = None
+    for time_scale in sorted(args.scales):
+        results = run_scale(time_scale, args.tests, args.jobs)
+        failed = sorted((r["number"], r["result"]) for r in results if r["exit_code"] not in (SUCCESS, UNSUPPORTED_OP))
+        cpu_time = sum(r["cpu_time"] for r in results)
+        if baseline_cpu is None:
+            baseline_cpu = cpu_time
+        print("x{:g} ({} ticks per cycle): {}/{} passed, {:.0f} CPU-seconds ({:.0f}% of x{:g}){}".format(
+            time_scale, int(round(cycle_ticks/time_scale)), len(results) - len(failed), len(results),
+            cpu_time, 100.0*cpu_time/baseline_cpu, min(args.scales),
+            "" if not failed else "; failed " + ", ".join("{} {}".format(n, result) for (n, result) in failed)))
+        sys.stdout.flush()
+        if failed:
+            # Passing again at a larger scale is luck, not headroom
+            passing = False
+            if not args.keep_going:
+                break
+        elif passing:
+            largest = time_scale
+    if largest is None:
+        print("The tests don't all pass at any of the time scales tried")
+        return 1
+    print("Largest time scale at which every test passes: x{:g}".format(largest))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# Settled-world snapshots for the Box2D SSEM.
+
+# Every test used to build the machine and then idle for a few hundred
+# ticks while the levers, cranks and hopper bearings fell into place.
+# That settled state is the same for every test on a given revision of
+# the machine, so we capture it once and cache it on disk. PyBox2D can't
+# serialise a world, so the machine is still constructed as usual; the
+# snapshot then puts every dynamic body back where it was after settling.
+
+import hashlib
+import json
+import os
+
+import Box2D
+from Box2D import b2_staticBody
+
+from settings import fwSettings, solver_options
+
+snapshot_format = 1
+
+source_dir = os.path.dirname(os.path.abspath(__file__))
+snapshot_dir = os.path.join(source_dir, "snapshots")
+
+# Anything which changes the machine or its physics changes the revision
+machine_sources = ["main.py", "constants.py", "cams.py", "settings.py", "framework.py"]
+
+def machine_revision():
+    """ A hash identifying this revision of the machine. """
+    h = hashlib.sha1()
+    h.update("{} {}".format(snapshot_format, Box2D.__version__).encode())
+    for name in machine_sources:
+        with open(os.path.join(source_dir, name), "rb") as f:
+            h.update(f.read())
+    # The machine settles differently under another solver profile
+    h.update(repr([getattr(fwSettings, option) for option in solver_options]).encode())
+    return h.hexdigest()
+
+def snapshot_filename(variant=None):
+    """ variant distinguishes differently built machines of the same revision, such as "kinematic". """
+    name = machine_revision() if variant is None else "{}-{}".format(machine_revision(), variant)
+    return os.path.join(snapshot_dir, "{}.json".format(name))
+
+def moving_bodies(machine):
+    """ The dynamic bodies, and any kinematic ones such as kinematic cams. """
+    return [b for b in machine.world.bodies if b.type != b2_staticBody]
+
+def capture_world(machine):
+    """ Returns a JSON-serialisable description of the machine's current state:
+    transforms and velocities of all moving bodies, joint motor speeds and
+    the plane of each ball bearing. Toggle positions are included with the
+    body transforms. """
+    bodies = []
+    for b in moving_bodies(machine):
+        bodies.append([b.position.x, b.position.y, b.angle,
+                       b.linearVelocity.x, b.linearVelocity.y, b.angularVelocity, b.awake])
+    motor_speeds = [getattr(j, "motorSpeed", None) for j in machine.world.joints]
+    return { "format": snapshot_format,
+             "bodies": bodies,
+             "motor_speeds": motor_speeds,
+             "bearing_planes": [plane for (b, plane) in machine.ball_bearings] }
+
+def restore_world(machine, data):
+    """ Puts the machine back into a state from capture_world. Returns False,
+    changing nothing, if the snapshot doesn't match this machine. """
+    bodies = moving_bodies(machine)
+    joints = machine.world.joints
+    if (data.get("format") != snapshot_format or len(data["bodies"]) != len(bodies)
+        or len(data["motor_speeds"]) != len(joints)
+        or len(data["bearing_planes"]) != len(machine.ball_bearings)):
+        return False
+    for (i, plane) in enumerate(data["bearing_planes"]):
+        (b, old_plane) = machine.ball_bearings[i]
+        if plane != old_plane:
+            machine.move_ball_bearing(i, b.worldCenter, plane)
+    for (b, (x, y, angle, vx, vy, angular_velocity, awake)) in zip(bodies, data["bodies"]):
+        b.transform = ((x, y), angle)
+        b.linearVelocity = (vx, vy)
+        b.angularVelocity = angular_velocity
+        b.awake = awake
+    for (j, speed) in zip(joints, data["motor_speeds"]):
+        if speed is not None:
+            j.motorSpeed = speed
+    return True
+
+def load_snapshot(variant=None):
+    """ Returns the cached snapshot for this revision, or None. """
+    try:
+        with open(snapshot_filename(variant)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_snapshot(data, variant=None):
+    # Write then rename, so parallel test runs never see a partial file
+    os.makedirs(snapshot_dir, exist_ok=True)
+    filename = snapshot_filename(variant)
+    temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temp_filename, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_filename, filename)